@@ -1,14 +1,40 @@
 import re
+import collections
 import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
 import os
+import random
+import sqlite3
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 
+import openai
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import snowflake.connector
 from openai import OpenAI
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None  # Token counts are estimated from the prompt length instead
+
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:
+    sqlglot = None  # Generated SQL is only checked with EXPLAIN
 
-client = OpenAI(api_key=st.secrets.openai_credentials.key)
 st.set_page_config(page_title="AI Data Analyst Demo", page_icon=":sparkles:", layout="wide")
 
 pd.set_option('display.max_columns', 500)
@@ -18,6 +44,43 @@ pd.set_option('display.width', 1000)
 # Set to True to use OpenAI endpoints directly. False to use DataRobot endpoints.
 openAImode = True
 
+# LLM backend settings
+llmTimeoutSeconds = 120
+llmMaxRetries = 4  # Retries on throttling (429), server errors and dropped connections
+llmRetryBaseSeconds = 1.0
+llmRetryMaxSeconds = 30.0
+llmMaxConcurrency = 8  # Most requests in flight per model or deployment. The limit adapts below this to throttling and latency.
+
+# Requests and tokens per minute allowed per OpenAI model or DataRobot deployment (task), shared by every session in the process
+llmRateLimits = {"gpt-4o": (500, 300000), "gpt-3.5-turbo": (3500, 1000000)}
+llmDefaultRateLimit = (300, 200000)
+llmExpectedOutputTokens = 800  # Added to the prompt's token count when reserving tokens for a request
+llmSlowdownFactor = 2.0  # A response this many times slower than usual counts as a sign of overload
+
+# Prompts sent to the same DataRobot deployment at about the same time are sent together in one predictions request
+dataRobotBatching = True
+dataRobotBatchWindowSeconds = 0.05  # How long the first prompt waits for others to join its batch
+dataRobotBatchMaxRows = 16
+
+# LLM responses are cached in SQLite under cacheDirectory, so they survive restarts and are shared by every process using that disk
+llmCacheEnabled = True
+llmCacheTTLSeconds = 7 * 24 * 3600
+llmCacheMaxBytes = 256 * 1024 * 1024  # Least recently used responses are evicted above this size
+
+# Prompts are assembled section by section and the least important sections are shortened until the prompt fits the model's budget
+promptTokenBudgets = {"gpt-4o": 100000, "gpt-3.5-turbo": 12000}
+promptDefaultTokenBudget = 12000  # Used for DataRobot deployments and models not listed above
+promptResultRows = 200  # Most rows of a query result included in a prompt
+promptMaxCellChars = 80  # Longer values are cut off in samples, frequent values and results
+
+# Failed attempts are described after the prompt so the next attempt can fix them. Only the most recent ones are kept.
+repairAttemptsKept = 2
+repairErrorChars = 600  # Longer errors and tracebacks keep their beginning and end
+repairCodeChars = 3000
+
+# Stream LLM output. The business analysis renders as it arrives and code generation stops reading at the closing code fence.
+streamingMode = True
+
 # Snowflake connection details
 user = st.secrets.snowflake_credentials.user
 password = st.secrets.snowflake_credentials.password
@@ -26,7 +89,86 @@ warehouse = st.secrets.snowflake_credentials.warehouse
 database = st.secrets.snowflake_credentials.database
 schema = st.secrets.snowflake_credentials.schema
 
-
+# Snowflake connection pool settings, shared by every session in this process
+snowflakePoolSize = 8  # Maximum number of open connections
+snowflakePoolWaitSeconds = 30  # How long a caller waits for a free connection before giving up
+snowflakePoolIdleSeconds = 600  # Idle connections older than this are closed
+snowflakePoolCheckSeconds = 60  # Connections idle longer than this are pinged before reuse
+
+# Snowflake error codes that mean the session or its token is no longer valid
+snowflakeSessionExpiredErrors = {390111, 390112, 390114}
+
+# Row counts come from table metadata. Set to True to also compute exact COUNT(*) row counts in the background.
+exactRowCounts = False
+exactRowCountSeconds = 3600  # How long an exact row count is reused before it is recomputed
+
+# Query results are streamed in Arrow batches and cut off at these limits
+snowflakeMaxResultRows = 100000
+snowflakeMaxResultBytes = 200 * 1024 * 1024
+
+# Generated queries run asynchronously and are cancelled if they haven't finished by the deadline
+snowflakeQueryTimeoutSeconds = 300
+snowflakePollSeconds = 0.5
+
+# Write several SQL candidates for each question at once, with different seeds and temperatures. They are checked
+# with EXPLAIN in parallel and the valid ones run cheapest first, so one round usually replaces several retries.
+speculativeSQL = True
+speculativeVariants = [(42, 0.7), (7, 0.9), (1234, 1.0)]  # (seed, temperature) per candidate
+
+# Generated SQL is checked before it runs. It is parsed locally (when sqlglot is installed) and checked against the schema's
+# tables and columns, then compiled with EXPLAIN. Queries the plan expects to scan more than the budget are rejected.
+sqlPreflightChecks = True
+sqlPreflightExplain = True
+snowflakeScanBudgetBytes = 100 * 1024 ** 3  # None for no budget
+
+# Local disk cache shared by every session and process running the app
+cacheDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# Results of user questions are cached as Parquet, keyed by the user, the normalized SQL and the database/schema
+queryCacheTTLSeconds = 24 * 3600
+queryCacheMaxBytes = 1024 ** 3  # Least recently used results are evicted above this size
+queryCacheCheckLastAltered = True  # Invalidate a cached result when one of its tables has changed since it was stored
+queryCacheLastAlteredSeconds = 60  # How long a table's LAST_ALTERED lookup is reused before Snowflake is asked again
+
+# Uploaded CSVs are parsed with the multithreaded pyarrow reader and stored compactly
+csvBlockBytes = 16 * 1024 * 1024  # Size of the blocks the reader parses in parallel
+csvCategoryRatio = 0.05  # Text columns with at most this share of distinct values are stored as categories
+csvCategoryMinRows = 100
+csvDowncastNumbers = True  # Store integers as int32 and floats as float32 when every value fits exactly
+
+# Parsed uploads are kept as uncompressed Arrow IPC files under cacheDirectory, keyed by the hash of the file's bytes,
+# and memory-mapped when any session opens the same file again
+csvCacheMaxBytes = 4 * 1024 ** 3  # Least recently used files are evicted above this size
+
+# Questions that were answered successfully are remembered with their SQL or Python, per table selection or uploaded file.
+# Asking the same question again (ignoring case, spacing and punctuation) reuses its code directly. A similar question
+# (TF-IDF similarity of character n-grams) only gets the remembered one added to the prompt as an example, since a small
+# change in wording ("shipped" and "not shipped") can need a different answer.
+answerCacheEnabled = True
+answerExampleSimilarity = 0.5
+answerCacheMaxQuestions = 500  # Most recently used questions compared per scope
+
+# Table lists and metadata are stored in SQLite so restarts and new replicas start warm.
+# Entries older than this are served as-is and refreshed in the background if LAST_ALTERED has changed.
+metadataRefreshSeconds = 15 * 60
+
+# Maximum number of tables summarized and sampled at the same time
+tableWorkers = 8
+
+# Data dictionaries of uploaded CSVs are written in chunks of columns sized to fit these token counts,
+# then merged locally and polished by the LLM in pieces of at most dictionaryAssembleTokens
+dictionaryWorkers = 4  # Maximum number of chunks or pieces sent to the LLM at the same time
+dictionaryChunkTokens = 2000
+dictionaryChunkMaxColumns = 30
+dictionaryAssembleTokens = 3000  # The polished piece comes back about this long, so keep it well inside the model's output limit
+
+# Table samples are sized to fit in this many bytes, up to the requested number of rows
+tableSampleMaxBytes = 2 * 1024 * 1024
+tableSampleBlockRows = 1000000  # Tables with more rows than this are sampled by block, which avoids scanning the whole table
+
+# Column profiles of Snowflake tables are computed in the warehouse
+profileTopK = 10
+profileSkipTypes = {"VARIANT", "OBJECT", "ARRAY", "GEOGRAPHY", "GEOMETRY", "BINARY", "VECTOR"}  # Types the profiler leaves out
 
 # Session state variables
 if "table_selection_button" not in st.session_state:
@@ -43,112 +185,1331 @@ if "selectedTables" not in st.session_state:
 if "csv_selection_button" not in st.session_state:
     st.session_state["csv_selection_button"] = False
 
-@st.cache_data(show_spinner=False)
-def getSnowflakeTableDescriptions(tables, user, password, account, warehouse, database, schema):
-    # Establish a connection to Snowflake
+class SnowflakeConnectionPool:
+    '''
+    Thread-safe pool of Snowflake connections shared by every session in the process
+    '''
+    def __init__(self, maxSize, waitSeconds, idleSeconds, checkSeconds, **connectArgs):
+        self.maxSize = maxSize
+        self.waitSeconds = waitSeconds
+        self.idleSeconds = idleSeconds
+        self.checkSeconds = checkSeconds
+        self.connectArgs = connectArgs
+        self.idle = []  # (connection, last used) pairs, most recently used last
+        self.openCount = 0
+        self.condition = threading.Condition()
+        self.stats = {"hits": 0, "misses": 0, "waits": 0, "waitSeconds": 0.0, "evictions": 0, "reconnects": 0}
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception as e:
+            print(f"Error closing Snowflake connection: {e}")
+
+    def _evictIdle(self):
+        # Close connections that have been sitting unused for too long. Caller holds the lock.
+        now = time.monotonic()
+        expired = [item for item in self.idle if now - item[1] > self.idleSeconds]
+        self.idle = [item for item in self.idle if now - item[1] <= self.idleSeconds]
+        for conn, lastUsed in expired:
+            self._close(conn)
+            self.openCount -= 1
+            self.stats["evictions"] += 1
+
+    def _isHealthy(self, conn, lastUsed):
+        if conn.is_closed():
+            return False
+        if time.monotonic() - lastUsed < self.checkSeconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except Exception as e:
+            print(f"Pooled Snowflake connection failed health check: {e}")
+            return False
+
+    def acquire(self):
+        start = time.monotonic()
+        waited = False
+        pooled = None
+        with self.condition:
+            self._evictIdle()
+            while not self.idle and self.openCount >= self.maxSize:
+                remaining = self.waitSeconds - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise TimeoutError(f"No Snowflake connection became available within {self.waitSeconds} seconds")
+                waited = True
+                self.condition.wait(remaining)
+            if self.idle:
+                pooled = self.idle.pop()
+                self.stats["hits"] += 1
+            else:
+                self.openCount += 1
+                self.stats["misses"] += 1
+            if waited:
+                self.stats["waits"] += 1
+                self.stats["waitSeconds"] += time.monotonic() - start
+
+        if pooled is not None:
+            conn, lastUsed = pooled
+            if self._isHealthy(conn, lastUsed):
+                return conn
+            self._close(conn)
+            self.stats["reconnects"] += 1
+
+        try:
+            return snowflake.connector.connect(**self.connectArgs)
+        except Exception:
+            with self.condition:
+                self.openCount -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, conn, broken=False):
+        with self.condition:
+            if broken or conn.is_closed():
+                self._close(conn)
+                self.openCount -= 1
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    def clear(self):
+        # Close every idle connection, e.g. after the session token has expired
+        with self.condition:
+            for conn, lastUsed in self.idle:
+                self._close(conn)
+                self.openCount -= 1
+            self.idle = []
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except snowflake.connector.errors.Error as e:
+            broken = isSessionExpired(e) or conn.is_closed()
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def run(self, work):
+        '''
+        Runs work(conn) on a pooled connection, reconnecting once if the session has expired
+        '''
+        try:
+            with self.connection() as conn:
+                return work(conn)
+        except snowflake.connector.errors.Error as e:
+            if not isSessionExpired(e):
+                raise
+            print(f"Snowflake session expired, reconnecting: {e}")
+            self.stats["reconnects"] += 1
+            self.clear()
+            with self.connection() as conn:
+                return work(conn)
+
+    def getStats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats["open"] = self.openCount
+            stats["idle"] = len(self.idle)
+            stats["inUse"] = self.openCount - len(self.idle)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hitRate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+def isSessionExpired(error):
+    return getattr(error, "errno", None) in snowflakeSessionExpiredErrors
+
+@st.cache_resource(show_spinner=False)
+def getSnowflakePool(user, password, account, warehouse, database, schema):
+    return SnowflakeConnectionPool(
+        maxSize=snowflakePoolSize,
+        waitSeconds=snowflakePoolWaitSeconds,
+        idleSeconds=snowflakePoolIdleSeconds,
+        checkSeconds=snowflakePoolCheckSeconds,
+        user=user,
+        password=password,
+        account=account,
+        warehouse=warehouse,
+        database=database,
+        schema=schema,
+        client_session_keep_alive=True
+    )
+
+def getSnowflakePoolStats():
+    '''
+    Pool hit/miss and wait-time stats for the app's Snowflake connections
+    '''
+    return getSnowflakePool(user, password, account, warehouse, database, schema).getStats()
+
+def quoteIdentifier(name):
+    # Quote a Snowflake identifier so that case and special characters are preserved
+    return '"' + str(name).replace('"', '""') + '"'
+
+def qualifyTable(table, database, schema):
+    # The database and schema from the settings are resolved by Snowflake's usual rules, as in the INFORMATION_SCHEMA
+    # queries, while table names come from INFORMATION_SCHEMA in their exact case
+    return f"{database}.{schema}.{quoteIdentifier(table)}"
+
+def openCacheDatabase():
+    os.makedirs(cacheDirectory, exist_ok=True)
+    db = sqlite3.connect(os.path.join(cacheDirectory, "cache.sqlite3"), timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+def writeAtomically(path, write):
+    '''
+    Calls write(temporaryPath) and then renames the file to path, so other sessions never read a partial file
+    '''
+    temporaryPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        conn = snowflake.connector.connect(
-            user=user,
-            password=password,
-            account=account,
-            warehouse=warehouse,
-            database=database,
-            schema=schema,
-            # Enable case sensitivity for identifiers
-            case_sensitive_identifier_quoting=True
-        )
-        cursor = conn.cursor()
-    except Exception as e:
-        print(f"Error connecting to Snowflake: {e}")
-        return None
+        write(temporaryPath)
+        os.replace(temporaryPath, path)
+    except BaseException:
+        try:
+            os.remove(temporaryPath)
+        except OSError:
+            pass
+        raise
 
-    # Function to get primary keys of a table
-    def get_primary_keys(table_name):
+def removeFile(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def evictLRU(folder, suffix, maxBytes, remove=removeFile):
+    '''
+    Removes the least recently modified files ending in suffix until those left in folder fit within maxBytes.
+    remove(path) deletes a file, along with anything stored next to it.
+    '''
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith(suffix):
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        remove(path)
+        total -= size
+
+def openMetadataStore():
+    db = openCacheDatabase()
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_tables (
+            account TEXT, database TEXT, schema TEXT, tables TEXT, fetched_at REAL,
+            PRIMARY KEY (account, database, schema))
+        """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS table_metadata (
+            account TEXT, database TEXT, schema TEXT, table_name TEXT, metadata TEXT, last_altered TEXT, fetched_at REAL,
+            PRIMARY KEY (account, database, schema, table_name))
+        """)
+    return db
+
+def loadStoredMetadata(tables, account, database, schema):
+    with contextlib.closing(openMetadataStore()) as db:
+        rows = db.execute(f"""
+            SELECT table_name, metadata, fetched_at
+            FROM table_metadata
+            WHERE account = ? AND database = ? AND schema = ?
+            AND table_name IN ({", ".join(["?"] * len(tables))})
+            """, [account, database, schema] + list(tables)).fetchall()
+    return {row[0]: (json.loads(row[1]), row[2]) for row in rows}
+
+def storeMetadata(metadata, account, database, schema):
+    # Entries from a partly failed fetch, or without columns, are fetched again next time instead of being stored
+    now = time.time()
+    rows = [(account, database, schema, table, json.dumps(entry, default=str), entry["lastAltered"], now)
+            for table, entry in metadata.items() if entry["complete"] and entry["columns"]]
+    with contextlib.closing(openMetadataStore()) as db, db:
+        db.executemany("INSERT OR REPLACE INTO table_metadata VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+@st.cache_resource(show_spinner=False)
+def getMetadataRefreshes():
+    # Keys of background metadata refreshes in progress, shared by every session
+    return {"lock": threading.Lock(), "running": set()}
+
+def refreshInBackground(key, refresh):
+    '''
+    Runs refresh() on the background executor unless a refresh for the same key is already running
+    '''
+    refreshes = getMetadataRefreshes()
+    with refreshes["lock"]:
+        if key in refreshes["running"]:
+            return
+        refreshes["running"].add(key)
+
+    def run_refresh():
         try:
-            cursor.execute(f"""
-                SELECT COLUMN_NAME
-                FROM {database}.INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
-                JOIN {database}.INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
-                ON tc.CONSTRAINT_NAME = kcu.CONSTRAINT_NAME
-                WHERE tc.CONSTRAINT_TYPE = 'PRIMARY KEY'
-                AND tc.TABLE_SCHEMA = '{schema}'
-                AND tc.TABLE_NAME = '{table_name}'
-                """)
-            return [row[0] for row in cursor.fetchall()]
+            refresh()
         except Exception as e:
-            print(f"Error fetching primary keys for table {table_name}: {e}")
-            return []
-
-    # Function to get columns and data types along with additional metadata
-    def get_columns_and_types(table_name):
+            print(f"Error refreshing metadata {key}: {e}")
+        finally:
+            with refreshes["lock"]:
+                refreshes["running"].discard(key)
+
+    getBackgroundExecutor().submit(run_refresh)
+
+def refreshStoredMetadata(tables, user, password, account, warehouse, database, schema):
+    # Refetch the tables whose LAST_ALTERED has changed and mark the rest as fresh
+    stored = loadStoredMetadata(tables, account, database, schema)
+    lastAltered = getLastAltered(tables, user, password, account, warehouse, database, schema)
+    changed = [table for table in tables if table not in stored or stored[table][0]["lastAltered"] != lastAltered.get(table)]
+    print(f"Metadata refresh: {len(changed)} of {len(tables)} tables changed")
+    if changed:
+        metadata = fetchSnowflakeTableMetadata(changed, user, password, account, warehouse, database, schema)
+        if metadata is not None:
+            storeMetadata(metadata, account, database, schema)
+    unchanged = [table for table in tables if table not in changed]
+    if unchanged:
+        with contextlib.closing(openMetadataStore()) as db, db:
+            db.executemany("UPDATE table_metadata SET fetched_at = ? WHERE account = ? AND database = ? AND schema = ? AND table_name = ?",
+                           [(time.time(), account, database, schema, table) for table in unchanged])
+
+@st.cache_data(show_spinner=False, ttl=metadataRefreshSeconds)
+def getSnowflakeTableMetadata(tables, user, password, account, warehouse, database, schema):
+    '''
+    Gets table metadata from the local store, fetching missing tables from Snowflake and refreshing stale ones in the background
+    '''
+    tables = list(tables)
+    if not tables:
+        return {}
+    try:
+        stored = loadStoredMetadata(tables, account, database, schema)
+    except Exception as e:
+        print(f"Error reading stored metadata: {e}")
+        stored = {}
+
+    metadata = {table: stored[table][0] for table in tables if table in stored}
+    missing = [table for table in tables if table not in stored]
+    if missing:
+        fetched = fetchSnowflakeTableMetadata(missing, user, password, account, warehouse, database, schema)
+        if fetched is None:
+            return None
         try:
-            cursor.execute(f"""
-                SELECT COLUMN_NAME, DATA_TYPE, IS_NULLABLE, COLUMN_DEFAULT, COMMENT
-                FROM {database}.INFORMATION_SCHEMA.COLUMNS
-                WHERE TABLE_SCHEMA = '{schema}'
-                AND TABLE_NAME = '{table_name}'
-                """)
-            columns = cursor.fetchall()
-            primary_keys = get_primary_keys(table_name)
-            return [(col[0], col[1], col[2] == 'YES', col[3], col[0] in primary_keys, col[4]) for col in columns]
+            storeMetadata(fetched, account, database, schema)
         except Exception as e:
-            print(f"Error fetching columns and types for table {table_name}: {e}")
-            return []
+            print(f"Error storing metadata: {e}")
+        metadata.update(fetched)
 
-    # Function to get table comment
-    def get_table_comment(table_name):
+    stale = [table for table in stored if time.time() - stored[table][1] > metadataRefreshSeconds]
+    if stale:
+        refreshInBackground(("metadata", account, database, schema, tuple(sorted(stale))),
+                            lambda: refreshStoredMetadata(stale, user, password, account, warehouse, database, schema))
+    return {table: metadata[table] for table in tables}
+
+def fetchSnowflakeTableMetadata(tables, user, password, account, warehouse, database, schema):
+    '''
+    Gets comments, row counts, columns and primary keys for all of the tables in a constant number of queries.
+    complete is False for every table if one of the queries failed.
+    '''
+    tables = list(tables)
+    metadata = {table: {"comment": None, "rowCount": None, "bytes": None, "lastAltered": None, "columns": [], "complete": False} for table in tables}
+    if not tables:
+        return metadata
+    placeholders = ", ".join(["%s"] * len(tables))
+
+    # Function to get table comments, row counts and sizes. Row counts come from metadata, so no table is scanned.
+    def get_table_info(cursor):
         try:
             cursor.execute(f"""
-                SELECT COMMENT
+                SELECT TABLE_NAME, COMMENT, ROW_COUNT, BYTES, LAST_ALTERED
                 FROM {database}.INFORMATION_SCHEMA.TABLES
-                WHERE TABLE_SCHEMA = '{schema}'
-                AND TABLE_NAME = '{table_name}'
-                """)
-            result = cursor.fetchone()
-            return result[0] if result else None
+                WHERE TABLE_SCHEMA = %s
+                AND TABLE_NAME IN ({placeholders})
+                """, [schema] + tables)
+            return {row[0]: row[1:] for row in cursor.fetchall()}
         except Exception as e:
-            print(f"Error fetching table comment for {table_name}: {e}")
+            print(f"Error fetching table comments and row counts: {e}")
             return None
 
-    # Function to get table row count
-    def get_table_row_count(table_name):
+    # Function to get primary keys of every table in the schema
+    def get_primary_keys(cursor):
         try:
-            cursor.execute(f"SELECT COUNT(*) FROM {schema}.{table_name}")
-            result = cursor.fetchone()
-            return result[0] if result else None
+            cursor.execute(f"SHOW PRIMARY KEYS IN SCHEMA {database}.{schema}")
+            names = [column[0].lower() for column in cursor.description]
+            primary_keys = {}
+            for row in cursor.fetchall():
+                record = dict(zip(names, row))
+                primary_keys.setdefault(record["table_name"], set()).add(record["column_name"])
+            return primary_keys
         except Exception as e:
-            print(f"Error fetching row count for table {table_name}: {e}")
+            print(f"Error fetching primary keys: {e}")
             return None
 
+    # Function to get columns and data types along with additional metadata
+    def get_columns_and_types(cursor):
+        try:
+            cursor.execute(f"""
+                SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE, IS_NULLABLE, COLUMN_DEFAULT, COMMENT
+                FROM {database}.INFORMATION_SCHEMA.COLUMNS
+                WHERE TABLE_SCHEMA = %s
+                AND TABLE_NAME IN ({placeholders})
+                ORDER BY TABLE_NAME, ORDINAL_POSITION
+                """, [schema] + tables)
+            columns = {}
+            for row in cursor.fetchall():
+                columns.setdefault(row[0], []).append(row[1:])
+            return columns
+        except Exception as e:
+            print(f"Error fetching columns and types: {e}")
+            return None
+
+    def fetch_metadata(conn):
+        with conn.cursor() as cursor:
+            return get_table_info(cursor), get_primary_keys(cursor), get_columns_and_types(cursor)
+
+    try:
+        table_info, primary_keys, columns = getSnowflakePool(user, password, account, warehouse, database, schema).run(fetch_metadata)
+    except Exception as e:
+        print(f"Error connecting to Snowflake: {e}")
+        return None
+
+    complete = table_info is not None and primary_keys is not None and columns is not None
+    table_info, primary_keys, columns = table_info or {}, primary_keys or {}, columns or {}
+    for table in tables:
+        keys = primary_keys.get(table, set())
+        comment, row_count, size, last_altered = table_info.get(table, (None, None, None, None))
+        metadata[table]["comment"] = comment
+        metadata[table]["rowCount"] = row_count
+        metadata[table]["bytes"] = size
+        metadata[table]["lastAltered"] = str(last_altered) if last_altered is not None else None
+        metadata[table]["columns"] = [(col[0], col[1], col[2] == 'YES', col[3], col[0] in keys, col[4]) for col in columns.get(table, [])]
+        metadata[table]["complete"] = complete
+    return metadata
+
+@st.cache_data(show_spinner=False, ttl=metadataRefreshSeconds)
+def getSnowflakeTableDescriptions(tables, user, password, account, warehouse, database, schema):
+    metadata = getSnowflakeTableMetadata(tables, user, password, account, warehouse, database, schema)
+    if metadata is None:
+        return None
+
     # Prepare the descriptions string
     descriptions = ""
 
     for table in tables:
         descriptions += f"Table: {table}\n"
-        table_comment = get_table_comment(table)
+        table_comment = metadata[table]["comment"]
         if table_comment:
             descriptions += f" Comment: {table_comment}\n"
-        row_count = get_table_row_count(table)
-        descriptions += f" Row Count: {row_count}\n"
-        for col_name, col_type, nullable, default, is_primary, col_comment in get_columns_and_types(table):
+        row_count = metadata[table]["rowCount"]
+        descriptions += f" Row Count: {row_count if row_count is not None else 'Unknown'}\n"
+        for col_name, col_type, nullable, default, is_primary, col_comment in metadata[table]["columns"]:
             descriptions += f' Column: "{col_name}", Type: {col_type}, Nullable: {nullable}, Default: {default}, Primary Key: {is_primary}, Comment: {col_comment}\n'
         descriptions += "---------------------------------------------------------------\n"
 
-    # Close the connection
-    cursor.close()
-    conn.close()
-
     return descriptions
 
+class AnswerCache:
+    '''
+    Answered questions and the code that answered them, stored in SQLite by scope. Similar questions are found locally
+    with TF-IDF over character n-grams.
+    '''
+    def __init__(self, maxQuestions):
+        self.maxQuestions = maxQuestions
+        self.lock = threading.Lock()
+        self.rows = {}  # scope -> (version, rows)
+        self.stats = {"reused": 0, "examples": 0, "misses": 0}
+        with contextlib.closing(openCacheDatabase()) as db, db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS answered_questions (
+                    scope TEXT, question TEXT, code TEXT, created_at REAL, last_used REAL, PRIMARY KEY (scope, question))
+                """)
+
+    @staticmethod
+    def normalize(question):
+        return " ".join(re.sub(r"[^\w\s]", " ", str(question).lower()).split())
+
+    def _rows(self, db, scope):
+        version = db.execute("SELECT COUNT(*), MAX(last_used) FROM answered_questions WHERE scope = ?", (scope,)).fetchone()
+        with self.lock:
+            cached = self.rows.get(scope)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        rows = db.execute("SELECT question, code FROM answered_questions WHERE scope = ? ORDER BY last_used DESC LIMIT ?",
+                          (scope, self.maxQuestions)).fetchall()
+        with self.lock:
+            self.rows[scope] = (version, rows)
+        return rows
+
+    def find(self, scope, question):
+        '''
+        Returns the most similar answered question in the scope as a dict with question, code, similarity and exact,
+        which is True when it is the same question after normalizing, or None
+        '''
+        question = self.normalize(question)
+        try:
+            with contextlib.closing(openCacheDatabase()) as db:
+                rows = self._rows(db, scope)
+        except Exception as e:
+            print(f"Error reading the answer cache: {e}")
+            return None
+        if not rows:
+            return None
+        for storedQuestion, code in rows:
+            if self.normalize(storedQuestion) == question:
+                return {"question": storedQuestion, "code": code, "similarity": 1.0, "exact": True}
+        # Fit on the new question too, so the n-grams only it has (like "not ") count against the match.
+        # Rows are L2 normalized, so the dot product is the cosine similarity.
+        vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 5), sublinear_tf=True)
+        matrix = vectorizer.fit_transform([storedQuestion for storedQuestion, _ in rows] + [question])
+        similarities = (matrix[:-1] @ matrix[-1].T).toarray().ravel()
+        best = int(similarities.argmax())
+        return {"question": rows[best][0], "code": rows[best][1], "similarity": float(similarities[best]), "exact": False}
+
+    def add(self, scope, question, code):
+        now = time.time()
+        try:
+            with contextlib.closing(openCacheDatabase()) as db, db:
+                db.execute("INSERT OR REPLACE INTO answered_questions VALUES (?, ?, ?, ?, ?)", (scope, self.normalize(question), code, now, now))
+        except Exception as e:
+            print(f"Error writing the answer cache: {e}")
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats)
+
+@st.cache_resource(show_spinner=False)
+def getAnswerCache():
+    return AnswerCache(maxQuestions=answerCacheMaxQuestions)
+
+def findAnsweredQuestion(scope, question):
+    '''
+    The same question answered before in scope, or the closest one if it is at least answerExampleSimilarity, otherwise None
+    '''
+    if not answerCacheEnabled:
+        return None
+    similar = getAnswerCache().find(scope, question)
+    if similar is None or similar["similarity"] < answerExampleSimilarity:
+        getAnswerCache().count("misses")
+        return None
+    getAnswerCache().count("reused" if similar["exact"] else "examples")
+    print(f"Similar answered question ({similar['similarity']:.2f}): {similar['question']}")
+    return similar
+
+def rememberAnswer(scope, question, code):
+    if answerCacheEnabled and code:
+        getAnswerCache().add(scope, question, code)
+
+def addAnswerExample(prompt, similar, language):
+    '''
+    Appends a similar answered question and its code to the prompt as an example
+    '''
+    return prompt + f"\n Similar Question Answered Before: \n{similar['question']}\n Code That Answered It: \n```{language}\n{similar['code']}\n```"
+
+@st.cache_resource(show_spinner=False)
+def getBackgroundExecutor():
+    # Worker threads shared by every session for work that shouldn't block the page
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="background")
+
+@st.cache_resource(show_spinner=False)
+def getExactRowCountJobs():
+    # Exact row count futures keyed by (account, database, schema, table), shared by every session
+    return {"lock": threading.Lock(), "jobs": {}}
+
+def getExactRowCounts(tables, user, password, account, warehouse, database, schema):
+    '''
+    Starts exact COUNT(*) row counts in the background and returns the ones that have finished
+    '''
+    pool = getSnowflakePool(user, password, account, warehouse, database, schema)
+
+    def count_rows(conn, table):
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {qualifyTable(table, database, schema)}")
+            return cursor.fetchone()[0]
+
+    exactCounts = getExactRowCountJobs()
+    counts = {}
+    with exactCounts["lock"]:
+        for table in tables:
+            key = (account, database, schema, table)
+            job = exactCounts["jobs"].get(key)
+            if job is None or time.monotonic() - job[1] > exactRowCountSeconds:
+                future = getBackgroundExecutor().submit(pool.run, lambda conn, table=table: count_rows(conn, table))
+                job = exactCounts["jobs"][key] = (future, time.monotonic())
+            future = job[0]
+            if future.done():
+                if future.exception() is None:
+                    counts[table] = future.result()
+                else:
+                    print(f"Error fetching exact row count for table {table}: {future.exception()}")
+    return counts
+
+def getSessionKey():
+    '''
+    The Streamlit session making the current call. Threads started without a session share one key.
+    '''
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else "background"
+
+def sessionExecutor(max_workers):
+    '''
+    A thread pool whose threads belong to the calling session, so their LLM calls are queued with that session's other calls
+    '''
+    ctx = get_script_run_ctx(suppress_warning=True)
+
+    def attachSession():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, initializer=attachSession)
+
+class LLMRateLimiter:
+    '''
+    Admission control for one model or deployment, shared by every session in the process.
+    A request waits for a concurrency slot and for room in two token buckets, requests per minute and tokens per minute.
+    The concurrency limit adapts (AIMD): it halves when the endpoint throttles, shrinks when responses get much slower
+    than usual, and otherwise grows by about one per limit's worth of successful requests.
+    Waiting requests are served round robin by session, so one session's burst can't hold up the others.
+    '''
+    def __init__(self, name, requestsPerMinute, tokensPerMinute, maxConcurrency):
+        self.name = name
+        self.requestsPerMinute = requestsPerMinute
+        self.tokensPerMinute = tokensPerMinute
+        self.maxConcurrency = maxConcurrency
+        self.limit = float(maxConcurrency)
+        self.inFlight = 0
+        self.requestLevel = float(requestsPerMinute)
+        self.tokenLevel = float(tokensPerMinute)
+        self.refilled = time.monotonic()
+        self.pausedUntil = 0.0
+        self.latency = None  # Moving average of successful response times
+        self.queues = collections.OrderedDict()  # session -> waiting tickets, in the order sessions will be served
+        self.condition = threading.Condition()
+        self.stats = {"requests": 0, "throttled": 0, "waitSeconds": 0.0}
+
+    def _refill(self, now):
+        elapsed = now - self.refilled
+        self.refilled = now
+        self.requestLevel = min(self.requestsPerMinute, self.requestLevel + elapsed * self.requestsPerMinute / 60)
+        self.tokenLevel = min(self.tokensPerMinute, self.tokenLevel + elapsed * self.tokensPerMinute / 60)
+
+    def _budgetWait(self, tokens, now):
+        # Seconds until the buckets can cover this request, or 0 if they can now
+        self._refill(now)
+        tokens = min(tokens, self.tokensPerMinute)
+        wait = max(0.0, self.pausedUntil - now)
+        if self.requestLevel < 1:
+            wait = max(wait, (1 - self.requestLevel) * 60 / self.requestsPerMinute)
+        if self.tokenLevel < tokens:
+            wait = max(wait, (tokens - self.tokenLevel) * 60 / self.tokensPerMinute)
+        return wait
+
+    def acquire(self, session, tokens):
+        ticket = object()
+        queued = time.monotonic()
+        with self.condition:
+            self.queues.setdefault(session, collections.deque()).append(ticket)
+            while True:
+                wait = 1.0
+                firstSession = next(iter(self.queues))
+                if firstSession == session and self.queues[session][0] is ticket and self.inFlight < max(1, int(self.limit)):
+                    now = time.monotonic()
+                    wait = self._budgetWait(tokens, now)
+                    if wait == 0:
+                        self.requestLevel -= 1
+                        self.tokenLevel -= min(tokens, self.tokensPerMinute)
+                        self.inFlight += 1
+                        self.queues[session].popleft()
+                        if self.queues[session]:
+                            self.queues.move_to_end(session)  # Let the next session go first
+                        else:
+                            del self.queues[session]
+                        self.stats["requests"] += 1
+                        self.stats["waitSeconds"] += now - queued
+                        self.condition.notify_all()
+                        return
+                self.condition.wait(wait)
+
+    def release(self, latency, throttled=False, pauseSeconds=0):
+        with self.condition:
+            self.inFlight -= 1
+            if throttled:
+                self.stats["throttled"] += 1
+                self.limit = max(1.0, self.limit / 2)
+                self.pausedUntil = max(self.pausedUntil, time.monotonic() + pauseSeconds)
+            elif self.latency is not None and latency > llmSlowdownFactor * self.latency:
+                self.limit = max(1.0, self.limit * 0.75)
+            else:
+                self.limit = min(float(self.maxConcurrency), self.limit + 1 / self.limit)
+            if not throttled:
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+            self.condition.notify_all()
+
+    def getStats(self):
+        with self.condition:
+            return dict(self.stats,
+                        limit=round(self.limit, 2),
+                        inFlight=self.inFlight,
+                        waiting=sum(len(queue) for queue in self.queues.values()))
+
+class LLMRequestError(Exception):
+    def __init__(self, message, statusCode=None, retryAfter=None):
+        super().__init__(message)
+        self.statusCode = statusCode
+        self.retryAfter = retryAfter
+
+class LLMBackend:
+    '''
+    Common interface for the OpenAI and DataRobot endpoints. Subclasses implement _send; this adds
+    retries with jittered backoff on throttling and server errors, and an LLMRateLimiter per model or deployment.
+    '''
+    name = "llm"
+    variesSampling = True  # Whether seed and temperature change the completion
+
+    def __init__(self, timeoutSeconds, maxRetries, maxConcurrency):
+        self.timeoutSeconds = timeoutSeconds
+        self.maxRetries = maxRetries
+        self.maxConcurrency = maxConcurrency
+        self.limiters = {}
+        self.limitersLock = threading.Lock()
+
+    def _send(self, task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt):
+        raise NotImplementedError
+
+    def _sendStream(self, task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt):
+        # Backends that can't stream return the whole completion as one piece
+        yield self._send(task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt)
+
+    def _isRetryable(self, error):
+        return False
+
+    def _isThrottled(self, error):
+        return getattr(error, "statusCode", None) == 429
+
+    def _limitKey(self, task, model):
+        return model
+
+    def _batched(self, task):
+        # Whether requests for task go through a batcher, which limits and retries each batch instead of each call
+        return False
+
+    def _limiter(self, task, model):
+        key = self._limitKey(task, model)
+        with self.limitersLock:
+            if key not in self.limiters:
+                requestsPerMinute, tokensPerMinute = llmRateLimits.get(key, llmDefaultRateLimit)
+                self.limiters[key] = LLMRateLimiter(key, requestsPerMinute, tokensPerMinute, self.maxConcurrency)
+            return self.limiters[key]
+
+    def getLimiterStats(self):
+        with self.limitersLock:
+            limiters = list(self.limiters.values())
+        return {limiter.name: limiter.getStats() for limiter in limiters}
+
+    def _retryDelay(self, error, attempt):
+        retryAfter = getattr(error, "retryAfter", None)
+        if retryAfter is not None:
+            return min(float(retryAfter), llmRetryMaxSeconds)
+        # Full jitter keeps sessions that were throttled together from retrying together
+        return random.uniform(0, min(llmRetryMaxSeconds, llmRetryBaseSeconds * 2 ** attempt))
+
+    def _cacheKey(self, task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt):
+        prompts = [hashlib.sha256(str(text).encode("utf-8")).hexdigest() for text in (systemPrompt, userPrompt, deploymentPrompt)]
+        return hashlib.sha256(json.dumps([self.name, task, model, temperature, seed] + prompts).encode("utf-8")).hexdigest()
+
+    def complete(self, task, systemPrompt, userPrompt, model="gpt-4o", temperature=0.7, seed=42, deploymentPrompt=None, cache=False):
+        '''
+        Returns the completion text. task names the DataRobot deployment, and deploymentPrompt overrides
+        the text sent to it when the deployment expects a different prompt than the chat model.
+        With cache=True the response is read from and saved to the persistent LLM response cache.
+        '''
+        key = None
+        if cache and llmCacheEnabled:
+            key = self._cacheKey(task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt)
+            cached = getLLMCache().get(key)
+            if cached is not None:
+                return cached
+
+        send = lambda: self._send(task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt)
+        if self._batched(task):
+            response = send()
+        else:
+            tokens = countTokens(str(systemPrompt) + str(userPrompt), model) + llmExpectedOutputTokens
+            response = self._sendWithRetries(task, model, tokens, send)
+
+        if key is not None:
+            getLLMCache().put(key, response)
+        return response
+
+    def _sendWithRetries(self, task, model, tokens, send):
+        '''
+        Calls send() once the rate limiter admits it, retrying throttling and server errors with backoff.
+        Each attempt is one request to the limiter, however many prompts it carries.
+        '''
+        limiter = self._limiter(task, model)
+        attempt = 0
+        while True:
+            limiter.acquire(getSessionKey(), tokens)
+            started = time.monotonic()
+            throttled = False
+            delay = 0
+            try:
+                return send()
+            except Exception as e:
+                throttled = self._isThrottled(e)
+                delay = self._retryDelay(e, attempt)
+                if attempt >= self.maxRetries or not self._isRetryable(e):
+                    raise
+                attempt += 1
+                print(f"{self.name} request for {task} failed with {repr(e)}, retry {attempt} of {self.maxRetries} in {delay:.1f}s")
+            finally:
+                limiter.release(time.monotonic() - started, throttled=throttled, pauseSeconds=delay if throttled else 0)
+            time.sleep(delay)
+
+    def stream(self, task, systemPrompt, userPrompt, model="gpt-4o", temperature=0.7, seed=42, deploymentPrompt=None, cache=False, until=None):
+        '''
+        Yields the completion text in pieces as they arrive. Requests are only retried if they fail before the first piece.
+        until(text) can end the stream early, once the text so far is all the caller needs.
+        With cache=True a cached response is yielded in one piece, and the response is saved when the stream ends or until ends it.
+        A stream the caller closes is cut short, so it isn't saved.
+        '''
+        if self._batched(task):
+            # A batched request can't stream, and the batcher limits and retries it
+            yield self.complete(task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt, cache)
+            return
+
+        key = None
+        if cache and llmCacheEnabled:
+            key = self._cacheKey(task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt)
+            cached = getLLMCache().get(key)
+            if cached is not None:
+                yield cached
+                return
+
+        limiter = self._limiter(task, model)
+        tokens = countTokens(str(systemPrompt) + str(userPrompt), model) + llmExpectedOutputTokens
+        attempt = 0
+        pieces = []
+        while True:
+            started = False
+            limiter.acquire(getSessionKey(), tokens)
+            startTime = time.monotonic()
+            firstPiece = None
+            throttled = False
+            delay = 0
+            try:
+                for piece in self._sendStream(task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt):
+                    if not started:
+                        firstPiece = time.monotonic() - startTime
+                    started = True
+                    pieces.append(piece)
+                    yield piece
+                    if until is not None and until("".join(pieces)):
+                        break
+                break
+            except GeneratorExit:
+                # The caller stopped reading, e.g. because the user asked something else
+                return
+            except Exception as e:
+                throttled = self._isThrottled(e)
+                delay = self._retryDelay(e, attempt)
+                if started or attempt >= self.maxRetries or not self._isRetryable(e):
+                    raise
+                attempt += 1
+                print(f"{self.name} stream for {task} failed with {repr(e)}, retry {attempt} of {self.maxRetries} in {delay:.1f}s")
+            finally:
+                # A stream's latency is its time to the first piece, since the caller decides how fast the rest is read
+                limiter.release(firstPiece if firstPiece is not None else time.monotonic() - startTime,
+                                throttled=throttled, pauseSeconds=delay if throttled else 0)
+            time.sleep(delay)
+
+        if key is not None and pieces:
+            getLLMCache().put(key, "".join(pieces))
+
+class LLMResponseCache:
+    '''
+    Content-addressed LLM responses stored in SQLite, with a TTL and least recently used eviction by total size
+    '''
+    def __init__(self, ttlSeconds, maxBytes):
+        self.ttlSeconds = ttlSeconds
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+        with contextlib.closing(openCacheDatabase()) as db, db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS llm_responses (
+                    key TEXT PRIMARY KEY, response TEXT, size INTEGER, created_at REAL, last_used REAL)
+                """)
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, key):
+        try:
+            with contextlib.closing(openCacheDatabase()) as db, db:
+                row = db.execute("SELECT response, created_at FROM llm_responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and time.time() - row[1] > self.ttlSeconds:
+                    db.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+                    row = None
+                if row is not None:
+                    db.execute("UPDATE llm_responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        except Exception as e:
+            print(f"Error reading the LLM response cache: {e}")
+            row = None
+        self._count("misses" if row is None else "hits")
+        return row[0] if row is not None else None
+
+    def put(self, key, response):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        try:
+            with contextlib.closing(openCacheDatabase()) as db, db:
+                db.execute("INSERT OR REPLACE INTO llm_responses VALUES (?, ?, ?, ?, ?)", (key, response, size, now, now))
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_responses").fetchone()[0]
+                if total > self.maxBytes:
+                    # Drop the least recently used responses until the cache fits
+                    excess = total - self.maxBytes
+                    for old_key, old_size in db.execute("SELECT key, size FROM llm_responses ORDER BY last_used").fetchall():
+                        if excess <= 0:
+                            break
+                        db.execute("DELETE FROM llm_responses WHERE key = ?", (old_key,))
+                        excess -= old_size
+        except Exception as e:
+            print(f"Error writing the LLM response cache: {e}")
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hitRate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+@st.cache_resource(show_spinner=False)
+def getLLMCache():
+    return LLMResponseCache(ttlSeconds=llmCacheTTLSeconds, maxBytes=llmCacheMaxBytes)
+
+def getLLMCacheStats():
+    '''
+    Hits, misses and hit rate of the persistent LLM response cache in this process
+    '''
+    return getLLMCache().getStats()
+
+class OpenAIBackend(LLMBackend):
+    name = "OpenAI"
+
+    def __init__(self, apiKey, timeoutSeconds, maxRetries, maxConcurrency):
+        super().__init__(timeoutSeconds, maxRetries, maxConcurrency)
+        # The client keeps a pool of keep-alive connections. Retries are handled by LLMBackend.
+        self.client = OpenAI(api_key=apiKey, timeout=timeoutSeconds, max_retries=0)
+
+    def _send(self, task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt):
+        response = self.client.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            seed=seed,
+            messages=[
+                {"role": "system", "content": systemPrompt},
+                {"role": "user", "content": userPrompt}])
+        return response.choices[0].message.content
+
+    def _sendStream(self, task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt):
+        response = self.client.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            seed=seed,
+            stream=True,
+            messages=[
+                {"role": "system", "content": systemPrompt},
+                {"role": "user", "content": userPrompt}])
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Stop downloading if the caller has stopped reading
+            response.close()
+
+    def _isRetryable(self, error):
+        return isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+    def _isThrottled(self, error):
+        return isinstance(error, openai.RateLimitError)
+
+    def _retryDelay(self, error, attempt):
+        response = getattr(error, "response", None)
+        retryAfter = response.headers.get("retry-after") if response is not None else None
+        if retryAfter is not None:
+            try:
+                return min(float(retryAfter), llmRetryMaxSeconds)
+            except ValueError:
+                pass
+        return super()._retryDelay(error, attempt)
+
+class PredictionBatcher:
+    '''
+    Collects prompts for one deployment that arrive within dataRobotBatchWindowSeconds of each other and sends them in
+    one request. The first caller in a window sends the batch, retrying it if needed, and every caller gets back the
+    prediction for its own row.
+    '''
+    def __init__(self, send):
+        self.send = send  # Takes a list of prompts and returns their predictions in the same order
+        self.lock = threading.Lock()
+        self.pending = None  # The batch still accepting prompts
+
+    def submit(self, prompt):
+        with self.lock:
+            batch = self.pending
+            leader = batch is None
+            if leader:
+                batch = self.pending = {"prompts": [], "predictions": None, "error": None,
+                                        "full": threading.Event(), "done": threading.Event()}
+            index = len(batch["prompts"])
+            batch["prompts"].append(prompt)
+            if len(batch["prompts"]) >= dataRobotBatchMaxRows:
+                batch["full"].set()
+                self.pending = None
+
+        if leader:
+            batch["full"].wait(dataRobotBatchWindowSeconds)
+            with self.lock:
+                if self.pending is batch:
+                    self.pending = None
+            try:
+                if len(batch["prompts"]) > 1:
+                    print(f"Sending {len(batch['prompts'])} prompts in one predictions request")
+                batch["predictions"] = self.send(batch["prompts"])
+            except Exception as e:
+                batch["error"] = e
+            finally:
+                batch["done"].set()
+        else:
+            batch["done"].wait()
+
+        error = batch["error"]
+        if isinstance(error, LLMRequestError):
+            # The leader has already retried the batch. Each caller raises its own copy so tracebacks aren't shared between threads
+            raise LLMRequestError(str(error), statusCode=error.statusCode, retryAfter=error.retryAfter) from error
+        if error is not None:
+            raise error
+        return batch["predictions"][index]
+
+class DataRobotBackend(LLMBackend):
+    name = "DataRobot"
+    variesSampling = False  # The deployments only take the prompt text
+
+    def __init__(self, predictionServer, apiKey, dataRobotKey, deployments, timeoutSeconds, maxRetries, maxConcurrency):
+        super().__init__(timeoutSeconds, maxRetries, maxConcurrency)
+        self.predictionServer = predictionServer
+        self.deployments = deployments
+        # One keep-alive session for every deployment, with enough pooled connections for maxConcurrency requests
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=maxConcurrency, pool_maxsize=maxConcurrency))
+        self.session.mount("http://", HTTPAdapter(pool_connections=maxConcurrency, pool_maxsize=maxConcurrency))
+        self.session.headers.update({
+            'Content-Type': 'application/json; charset=UTF-8',
+            'Authorization': 'Bearer {}'.format(apiKey),
+            'DataRobot-Key': dataRobotKey,
+        })
+        self.batchers = {}
+        self.batchersLock = threading.Lock()
+
+    def _send(self, task, systemPrompt, userPrompt, model, temperature, seed, deploymentPrompt):
+        deployment_id = self.deployments[task]
+        prompt = deploymentPrompt if deploymentPrompt is not None else userPrompt
+        if not dataRobotBatching:
+            return self._predict(deployment_id, [prompt])[0]
+        with self.batchersLock:
+            if task not in self.batchers:
+                self.batchers[task] = PredictionBatcher(lambda prompts: self._sendBatch(task, model, deployment_id, prompts))
+            batcher = self.batchers[task]
+        return batcher.submit(prompt)
+
+    def _sendBatch(self, task, model, deployment_id, prompts):
+        # The whole batch takes one request from the limiter and is retried as one request
+        tokens = sum(countTokens(str(prompt), model) + llmExpectedOutputTokens for prompt in prompts)
+        return self._sendWithRetries(task, model, tokens, lambda: self._predict(deployment_id, prompts))
+
+    def _predict(self, deployment_id, prompts):
+        '''
+        Scores several prompts in one request and returns the predictions in the order of the prompts
+        '''
+        url = f'{self.predictionServer}/predApi/v1.0/deployments/{deployment_id}/predictions'
+        data = pd.DataFrame({"promptText": prompts})
+        try:
+            predictions_response = self.session.post(url, data=data.to_json(orient='records'), timeout=self.timeoutSeconds)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise LLMRequestError(f"DataRobot request failed: {e}") from e
+        if predictions_response.status_code == 429 or predictions_response.status_code >= 500:
+            raise LLMRequestError(f"DataRobot returned {predictions_response.status_code}: {predictions_response.text[:500]}",
+                                  statusCode=predictions_response.status_code,
+                                  retryAfter=predictions_response.headers.get("Retry-After"))
+        predictions_response.raise_for_status()
+        rows = predictions_response.json()["data"]
+        if len(rows) != len(prompts):
+            raise ValueError(f"DataRobot returned {len(rows)} predictions for {len(prompts)} prompts")
+        rows = sorted(rows, key=lambda row: row.get("rowId", 0))
+        return [row["prediction"] for row in rows]
+
+    def _limitKey(self, task, model):
+        # Each deployment has its own limits, whatever model is behind it
+        return task
+
+    def _batched(self, task):
+        return dataRobotBatching
+
+    def _isRetryable(self, error):
+        return isinstance(error, LLMRequestError)
+
+    def _retryDelay(self, error, attempt):
+        try:
+            return super()._retryDelay(error, attempt)
+        except ValueError:
+            # Retry-After can also be an HTTP date
+            error.retryAfter = None
+            return super()._retryDelay(error, attempt)
+
+@st.cache_resource(show_spinner=False)
+def createLLMBackend(useOpenAI):
+    if useOpenAI:
+        return OpenAIBackend(
+            apiKey=st.secrets.openai_credentials.key,
+            timeoutSeconds=llmTimeoutSeconds,
+            maxRetries=llmMaxRetries,
+            maxConcurrency=llmMaxConcurrency)
+    return DataRobotBackend(
+        predictionServer=st.secrets.datarobot_credentials.PREDICTION_SERVER,
+        apiKey=st.secrets.datarobot_credentials.API_KEY,
+        dataRobotKey=st.secrets.datarobot_credentials.DATAROBOT_KEY,
+        deployments=dict(st.secrets.datarobot_deployment_id),
+        timeoutSeconds=llmTimeoutSeconds,
+        maxRetries=llmMaxRetries,
+        maxConcurrency=llmMaxConcurrency)
+
+def getLLMBackend():
+    '''
+    The backend chosen by openAImode, shared by every session in the process
+    '''
+    return createLLMBackend(openAImode)
+
+def getLLMLimiterStats():
+    '''
+    Requests, throttling, waiting time and the current concurrency limit per model or deployment
+    '''
+    return getLLMBackend().getLimiterStats()
+
+@st.cache_resource(show_spinner=False)
+def getTokenizer(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        print(f"No tokenizer for {model}, estimating token counts: {repr(e)}")
+        return None
+
+def countTokens(text, model="gpt-4o"):
+    tokenizer = getTokenizer(model)
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+def getPromptTokenBudget(model):
+    return promptTokenBudgets.get(model, promptDefaultTokenBudget) if openAImode else promptDefaultTokenBudget
+
+def clipValue(value, maxChars=promptMaxCellChars):
+    text = str(value)
+    return text if len(text) <= maxChars else text[:maxChars - 3] + "..."
+
+def renderTable(df, maxRows=promptResultRows):
+    '''
+    Renders a DataFrame as CSV under a line giving its shape and column types. Long values are cut off.
+    '''
+    if df is None:
+        return "None"
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+    if not isinstance(df, pd.DataFrame):
+        return clipValue(df, promptMaxCellChars * 50)
+    header = f"{len(df)} rows x {len(df.columns)} columns. Types: " + ", ".join(f"{column} ({dtype})" for column, dtype in df.dtypes.items())
+    shown = df.head(maxRows).map(lambda value: clipValue(value) if isinstance(value, str) else value)
+    text = header + "\n" + shown.to_csv(index=not isinstance(df.index, pd.RangeIndex))  # Keep meaningful indexes, like group keys
+    if len(df) > maxRows:
+        text += f"... {len(df) - maxRows} more rows\n"
+    return text
+
+def renderTableOptions(df):
+    '''
+    The full table, then fewer rows, then just the shape and column types
+    '''
+    return [renderTable(df), renderTable(df, maxRows=20), renderTable(df, maxRows=0)]
+
+def renderSamples(samples, maxRows=3):
+    '''
+    Renders samples column by column, one line per column, which stays compact for wide tables.
+    samples is a DataFrame or a dict of table name to DataFrame.
+    '''
+    if isinstance(samples, pd.DataFrame):
+        samples = {None: samples}
+    lines = []
+    for table, sample in samples.items():
+        if table is not None:
+            lines.append(f"{table}:")
+        for i, column in enumerate(sample.columns):
+            values = " | ".join(clipValue(value) for value in sample.iloc[:maxRows, i].tolist())
+            lines.append(f"{column} ({sample.dtypes.iloc[i]}): {values}")
+    return "\n".join(lines)
+
+def renderFrequentValues(frequentValues, maxValues=10):
+    '''
+    One line per column with its most frequent values, if it has them, plus the profile statistics when there are any
+    '''
+    if frequentValues is None or frequentValues.empty:
+        return ""
+    lines = []
+    for _, row in frequentValues.iterrows():
+        values = row.get("Frequent Values")
+        values = values if isinstance(values, (list, tuple)) else []
+        line = str(row['Non-numeric column name'])
+        if values:
+            line += ": " + ", ".join(clipValue(value) for value in values[:maxValues])
+        stats = [f"{label.lower()} {clipValue(row[label])}" for label in ("Distinct Count", "Null Fraction", "Min", "Max")
+                 if label in row and pd.notna(row[label])]
+        if stats:
+            line += " (" + ", ".join(stats) + ")"
+        lines.append(line)
+    return "\n".join(lines)
+
+def renderCategoricalColumns(df):
+    '''
+    Names the columns stored as pandas categories, with how to work with them, or "" if there are none
+    '''
+    columns = [str(column) for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+    if not columns:
+        return ""
+    return (", ".join(columns) + "\n"
+            "These columns have the pandas category dtype. Pass observed=True to groupby and pivot_table so unused categories "
+            "don't add empty groups, and convert a column with .astype(str) before assigning values that aren't already among its categories.")
+
+def buildPrompt(stage, sections, model="gpt-4o"):
+    '''
+    Joins the sections into a prompt that fits the model's token budget.
+    Each section is (title, priority, renderings), with renderings ordered from the most to the least detailed.
+    While the prompt is over budget, the lowest priority section that can still shrink moves to its next rendering.
+    An empty rendering drops the section, and a title of None leaves out the heading.
+    '''
+    budget = getPromptTokenBudget(model)
+    levels = [0] * len(sections)
+
+    def assemble():
+        parts = []
+        for (title, priority, renderings), level in zip(sections, levels):
+            text = str(renderings[level])
+            if text:
+                parts.append(text if title is None else f"{title}: \n{text}")
+        return "\n ".join(parts)
+
+    prompt = assemble()
+    tokens = countTokens(prompt, model)
+    while tokens > budget:
+        shrinkable = [i for i, (title, priority, renderings) in enumerate(sections) if levels[i] < len(renderings) - 1]
+        if not shrinkable:
+            break
+        i = min(shrinkable, key=lambda i: sections[i][1])
+        levels[i] += 1
+        prompt = assemble()
+        tokens = countTokens(prompt, model)
+
+    shortened = [str(title) for (title, priority, renderings), level in zip(sections, levels) if level]
+    print(f"Prompt tokens for {stage}: {tokens} of {budget}" + (f", shortened {', '.join(shortened)}" if shortened else ""))
+    return prompt
+
+def clipMiddle(text, maxChars):
+    text = str(text)
+    if len(text) <= maxChars:
+        return text
+    half = (maxChars - 5) // 2
+    return text[:half] + "\n...\n" + text[-half:]
+
+class RepairContext:
+    '''
+    The most recent failed attempts, rendered as a suffix to a base prompt that stays the same on every attempt.
+    Repeated errors are shown once with a count, and long errors and code are cut down.
+    '''
+    def __init__(self, label, maxAttempts=repairAttemptsKept):
+        self.label = label
+        self.maxAttempts = maxAttempts
+        self.attempts = 0
+        self.failures = []  # [attempt, error, details, repeats], oldest first
+
+    def add(self, error, details=None):
+        self.attempts += 1
+        error = repr(error) if isinstance(error, BaseException) else str(error)
+        lines = error.strip().splitlines()
+        if len(lines) > 8:
+            # Keep the start of a traceback and the lines nearest the error
+            lines = lines[:2] + ["..."] + lines[-5:]
+        error = clipMiddle("\n".join(lines), repairErrorChars)
+        details = clipMiddle(details, repairCodeChars) if details is not None else None
+        repeats = 0
+        for failure in self.failures:
+            if failure[1] == error:
+                repeats = failure[3] + 1
+        self.failures = [failure for failure in self.failures if failure[1] != error]
+        self.failures.append([self.attempts, error, details, repeats])
+        self.failures = self.failures[-self.maxAttempts:]
+
+    def render(self):
+        if not self.failures:
+            return ""
+        text = ""
+        shown = len(self.failures) + sum(failure[3] for failure in self.failures)
+        if self.attempts > shown:
+            text += f"\n{self.attempts - shown} earlier attempts also failed."
+        for attempt, error, details, repeats in self.failures:
+            text += f"\n{self.label} FAILED! Attempt {attempt} failed with error: {error}"
+            if repeats:
+                text += f" (the same error also happened {repeats} earlier times)"
+            if details is not None:
+                text += f"\n{details}"
+        return text
+
+def extractCode(response, language):
+    # Pattern to match code blocks that optionally start with ```<language> or just ```
+    pattern = r'```(?:' + language + r')?\n(.*?)```'
+    matches = re.findall(pattern, response, re.DOTALL)
+
+    # Join all matches into a single string, separated by two newlines. Use the whole response if there were no code fences.
+    return '\n\n'.join(matches) if matches else response
+
+def generateCode(language, **request):
+    '''
+    Gets code from the LLM. When streaming, stops reading as soon as the first code block has been closed.
+    '''
+    if not streamingMode:
+        response = getLLMBackend().complete(**request)
+    else:
+        pattern = r'```(?:' + language + r')?\n(.*?)```'
+        # The stream ends, and is cached, as soon as the code block is complete
+        response = "".join(getLLMBackend().stream(**request, until=lambda text: re.search(pattern, text, re.DOTALL)))
+    print(response)
+    return extractCode(response, language)
+
 @st.cache_data(show_spinner=False)
 def suggestQuestion(description):
-    response = client.chat.completions.create(
+    response = getLLMBackend().complete(
+        task="suggest_a_question",
         model="gpt-4o",
         temperature=0.7,
         seed=42,
-        messages=[
-            {"role": "system",
-             "content": """
+        systemPrompt="""
                             <YOUR ROLE>
                             Your job is to examine some meta data and suggest 3 business analytics questions that might yeild interesting insight from the data.
                             Inspect the user's metadata and suggest 3 different questions. They might be related, or completely unrelated to one another. 
@@ -171,43 +1532,20 @@ def suggestQuestion(description):
                             Do not refer to specific column names or tables in the data. Just use common language when suggesting a question. Let the next analyst figure out which columns and tables they'll need to use. 
                             </NECESSARY CONSIDERATIONS>
                                                         
-            """},
-            {"role": "user", "content": description}])
-    print(response.choices[0].message.content)
-    return response.choices[0].message.content
-
-@st.cache_data(show_spinner=False)
-def suggestQuestion2(description):
-    # description = "this is a test."
-    data = pd.DataFrame({"promptText": [description]})
-    deployment_id = st.secrets.datarobot_deployment_id.suggest_a_question
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    suggestion = predictions_response.json()["data"][0]["prediction"]
-    return suggestion
+            """,
+        userPrompt=description,
+        cache=True)
+    print(response)
+    return response
 
 @st.cache_data(show_spinner=False)
 def summarizeTable(dictionary, table):
-    response = client.chat.completions.create(
+    response = getLLMBackend().complete(
+        task="summarize_table",
         model="gpt-4o",
         temperature=0.7,
         seed=42,
-        messages=[
-            {"role": "system",
-             "content": f"""
+        systemPrompt=f"""
                             YOUR ROLE:
                             Your job is to examine some meta data and come up with a brief description of the dataset, 2 - 5 sentences long. 
                             Inspect the user's metadata and write the description for the table called {table}.
@@ -223,43 +1561,21 @@ def summarizeTable(dictionary, table):
                             A description of the {table} table 2 or 5 sentences, no more.
                             Format as markdown.    
                             Do not include any headers.                        
-            """},
-            {"role": "user", "content": dictionary}])
-    print(response.choices[0].message.content)
-    return response.choices[0].message.content
-
-@st.cache_data(show_spinner=False)
-def summarizeTable2(dictionary, table):
-    # table = "This is a test"
-    # dictionary = "this is a test dictionary."
-    data = pd.DataFrame({"promptText": [str(dictionary) + "\nTABLE TO DESCRIBE: " + str(table)]})
-    deployment_id = st.secrets.datarobot_deployment_id.summarize_table
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    summary = predictions_response.json()["data"][0]["prediction"]
-    return summary
+            """,
+        userPrompt=dictionary,
+        deploymentPrompt=str(dictionary) + "\nTABLE TO DESCRIBE: " + str(table),
+        cache=True)
+    print(response)
+    return response
 
 @st.cache_data(show_spinner=False)
 def getDataDictionary(prompt):
-    response = client.chat.completions.create(
+    response = getLLMBackend().complete(
+        task="data_dictionary_maker",
         model="gpt-3.5-turbo",
         temperature=0.7,
         seed=42,
-        messages=[
-            {"role": "system",
-             "content": """
+        systemPrompt="""
         <ROLE>
         You are a data dictionary maker. 
         Inspect this metadata to decipher what each column in the dataset is about is about. 
@@ -286,46 +1602,20 @@ def getDataDictionary(prompt):
         | Row 2, Col 1 | Row 2, Col 2 | Row 2, Col 3 |
         | Row 3, Col 1 | Row 3, Col 2 | Row 3, Col 3 | 
         </CONSIDERATIONS>
-        """},
-            {"role": "user", "content": prompt}])
-    print(response.choices[0].message.content)
-    return response.choices[0].message.content
-
-@st.cache_data(show_spinner=False)
-def getDataDictionary2(prompt):
-    '''
-    Submits the data, gets dictionary
-    '''
-    #prompt = data
-
-    data = pd.DataFrame({"promptText": [prompt]})
-    deployment_id = st.secrets.datarobot_deployment_id.data_dictionary_maker
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
-    return code
+        """,
+        userPrompt=prompt,
+        cache=True)
+    print(response)
+    return response
 
 @st.cache_data(show_spinner=False)
 def assembleDictionaryParts(parts):
-    response = client.chat.completions.create(
+    response = getLLMBackend().complete(
+        task="data_dictionary_assembler",
         model="gpt-3.5-turbo",
         temperature=0.7,
         seed=42,
-        messages=[
-            {"role": "system",
-             "content": """
+        systemPrompt="""
             <ROLE>
             You are a data dictionary assembler.          
             A data dictionary explains to users what the columns of a dataset are about, and how that data could be used for analysis.
@@ -364,45 +1654,148 @@ def assembleDictionaryParts(parts):
             | Left       | Center       | Right       |
             | Left       | Center       | Right       |
              </YOUR RESPONSE>           
-            """},
-            {"role": "user", "content": str(parts)}])
-    print(response.choices[0].message.content)
-    return response.choices[0].message.content
+            """,
+        userPrompt="\n\n".join(parts),
+        cache=True)
+    print(response)
+    return response
 
-@st.cache_data(show_spinner=False)
-def assembleDictionaryParts2(parts):
-    '''
-       Submits the data, assembles dictionary
-    '''
-    # parts = data
-
-    data = pd.DataFrame({"promptText": [parts]})
-    deployment_id = st.secrets.datarobot_deployment_id.data_dictionary_assembler
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    assembled = predictions_response.json()["data"][0]["prediction"]
-    return assembled
+def buildDictionaryChunkPrompts(df, frequentValues):
+    '''
+    Splits the columns, in order, into chunks whose prompts fit in dictionaryChunkTokens and returns a prompt for each chunk
+    '''
+    def columnFrequentValues(columns):
+        if frequentValues.empty:
+            return frequentValues
+        return frequentValues[frequentValues["Non-numeric column name"].isin(columns)]
+
+    chunks = [[]]
+    chunkTokens = 0
+    for i in range(len(df.columns)):
+        tokens = countTokens(renderTable(df.iloc[:10, [i]], maxRows=10) + renderFrequentValues(columnFrequentValues(df.columns[[i]])), "gpt-3.5-turbo")
+        if chunks[-1] and (chunkTokens + tokens > dictionaryChunkTokens or len(chunks[-1]) >= dictionaryChunkMaxColumns):
+            chunks.append([])
+            chunkTokens = 0
+        chunks[-1].append(i)
+        chunkTokens += tokens
+
+    prompts = []
+    for number, columns in enumerate(chunk for chunk in chunks if chunk):
+        subset = df.iloc[:10, columns]
+        chunkFrequentValues = columnFrequentValues(subset.columns)
+        prompts.append(buildPrompt(f"dictionary chunk {number + 1}", [
+            ("First 10 Rows", 2, [renderTable(subset, maxRows=10), renderTable(subset, maxRows=3)]),
+            ("Unique and Frequent Values of Categorical Data", 1, [renderFrequentValues(chunkFrequentValues), renderFrequentValues(chunkFrequentValues, maxValues=3), ""])],
+            model="gpt-3.5-turbo"))
+    return prompts
+
+def parseMarkdownTable(text):
+    '''
+    Returns the header cells and rows of the first markdown table in text, or None if there isn't one
+    '''
+    header = None
+    rows = []
+    for line in str(text).splitlines():
+        line = line.strip()
+        if not line.startswith("|"):
+            if rows:
+                break
+            continue
+        cells = [cell.strip() for cell in line.strip("|").split("|")]
+        if header is None:
+            header = cells
+        elif not rows and all(re.fullmatch(r":?-+:?", cell) for cell in cells if cell):
+            continue  # The separator line under the header
+        else:
+            rows.append(cells)
+    return (header, rows) if header is not None and rows else None
+
+def renderMarkdownTable(header, rows):
+    lines = ["| " + " | ".join(header) + " |", "|" + "|".join(":---" for _ in header) + "|"]
+    lines += ["| " + " | ".join(row) + " |" for row in rows]
+    return "\n".join(lines)
+
+def mergeMarkdownTables(tables):
+    '''
+    Concatenates parsed tables under the first table's header. Rows are matched to the header's width
+    and a column described more than once keeps its first description.
+    '''
+    header = tables[0][0]
+    rows = []
+    seen = set()
+    for _, tableRows in tables:
+        for row in tableRows:
+            key = re.sub(r"[`*_\s]", "", row[0]).lower() if row else ""
+            if key in seen:
+                continue
+            seen.add(key)
+            row = row[:len(header)] + [""] * (len(header) - len(row))
+            rows.append(row)
+    return header, rows
+
+def splitMarkdownTable(header, rows, maxTokens):
+    '''
+    Splits the rows into tables, each with the header, of at most maxTokens
+    '''
+    pieces = [[]]
+    pieceTokens = countTokens(renderMarkdownTable(header, []), "gpt-3.5-turbo")
+    headerTokens = pieceTokens
+    for row in rows:
+        tokens = countTokens(renderMarkdownTable(header, [row]), "gpt-3.5-turbo") - headerTokens
+        if pieces[-1] and pieceTokens + tokens > maxTokens:
+            pieces.append([])
+            pieceTokens = headerTokens
+        pieces[-1].append(row)
+        pieceTokens += tokens
+    return [renderMarkdownTable(header, piece) for piece in pieces if piece]
+
+def assembleDictionary(parts):
+    '''
+    Combines partial data dictionaries. When every part is a markdown table, the rows are merged locally and the
+    LLM only polishes pieces of the merged table, in parallel. Otherwise the parts are merged by the LLM in a tree,
+    a few parts per call, until one dictionary is left.
+    '''
+    parts = list(parts)
+    tables = [parseMarkdownTable(part) for part in parts]
+    with sessionExecutor(max_workers=dictionaryWorkers) as executor:
+        if parts and all(tables):
+            header, rows = mergeMarkdownTables(tables)
+            pieces = splitMarkdownTable(header, rows, dictionaryAssembleTokens)
+            print(f"Assembling a dictionary of {len(rows)} columns from {len(parts)} parts in {len(pieces)} pieces")
+            polished = list(executor.map(lambda piece: assembleDictionaryParts([piece]), pieces))
+            if len(polished) == 1:
+                return polished[0]
+            polishedTables = [parseMarkdownTable(piece) for piece in polished]
+            if all(polishedTables):
+                return renderMarkdownTable(*mergeMarkdownTables(polishedTables))
+            return "\n\n".join(polished)
+
+        while True:
+            # Group parts up to the token budget, at least two to a group so every level shrinks
+            groups = [[]]
+            groupTokens = 0
+            for part in parts:
+                tokens = countTokens(part, "gpt-3.5-turbo")
+                if len(groups[-1]) >= 2 and groupTokens + tokens > dictionaryAssembleTokens:
+                    groups.append([])
+                    groupTokens = 0
+                groups[-1].append(part)
+                groupTokens += tokens
+            if len(groups) > 1 and len(groups[-1]) == 1:
+                groups[-2].extend(groups.pop())
+            print(f"Merging {len(parts)} dictionary parts in {len(groups)} groups")
+            parts = list(executor.map(assembleDictionaryParts, groups))
+            if len(parts) == 1:
+                return parts[0]
 
 def getPythonCode(prompt):
-    response = client.chat.completions.create(
+    return generateCode(
+        "python",
+        task="python_code_generator",
         model="gpt-4o",
         temperature=0.7,
         seed=42,
-        messages=[
-            {"role": "system",
-             "content": """
+        systemPrompt="""
                 <ROLE>                
                 You are a Python Pandas expert
                 Your job is to write Pandas code that retrieves all the data needed to fully explain the answer to the user's business question.                   
@@ -454,67 +1847,35 @@ def getPythonCode(prompt):
                 'QUERY FAILED! Attempt X failed with error: <error>  
                 Take this error message into consideration when building your function so that the problem doesn't happen again.                
                 Try again, but don't fail this time.
-                </REATTEMPT>            """},
-            {"role": "user", "content": prompt}])
-    print(response.choices[0].message.content)
-    # Pattern to match code blocks that optionally start with ```python or just ```
-    pattern = r'```(?:python)?\n(.*?)```'
-    matches = re.findall(pattern, response.choices[0].message.content, re.DOTALL)
-
-    # Join all matches into a single string, separated by two newlines
-    python_code = '\n\n'.join(matches)
-    return python_code
-
-def getPythonCode2(prompt):
-    '''
-    Submits the user's prompt to DataRobot, gets Python
-    '''
-    # prompt = "test"
-    data = pd.DataFrame({"promptText": [prompt]})
-    deployment_id = st.secrets.datarobot_deployment_id.python_code_generator
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
-    return code
+                </REATTEMPT>            """,
+        userPrompt=prompt,
+        cache=True)
 
 def executePythonCode(prompt, df):
     '''
     Executes the Python Code generated by the LLM
     '''
     print("Generating code...")
-    if openAImode:
-        pythonCode = getPythonCode(prompt)
-    else:
-        pythonCode = getPythonCode2(prompt)
+    pythonCode = getPythonCode(prompt)
     print(pythonCode.replace("```python", "").replace("```", ""))
     pythonCode = pythonCode.replace("```python", "").replace("```", "")
+    return pythonCode, runPythonCode(pythonCode, df)
+
+def runPythonCode(pythonCode, df):
     print("Executing...")
     function_dict = {}
     exec(pythonCode, function_dict)  # execute the code created by our LLM
     analyze_data = function_dict['analyze_data']  # get the function that our code created
-    results = analyze_data(df)
-    return pythonCode, results
+    return analyze_data(df)
 
-def getSnowflakeSQL(prompt, warehouse=warehouse, database=database, schema=schema):
-    response = client.chat.completions.create(
+def getSnowflakeSQL(prompt, warehouse=warehouse, database=database, schema=schema, seed=42, temperature=0.7):
+    return generateCode(
+        "sql",
+        task="sql_code_generator",
         model="gpt-4o",
-        temperature=0.7,
-        seed=42,
-        messages=[
-            {"role": "system",
-             "content": f"""
+        temperature=temperature,
+        seed=seed,
+        systemPrompt=f"""
                 <ROLE>                
                 You are a Snowflake SQL query maker.
                 Your job is to write a Snowflake SQL query that retrieves all the data needed to fully explain the answer to the user's business question.                   
@@ -571,101 +1932,490 @@ def getSnowflakeSQL(prompt, warehouse=warehouse, database=database, schema=schem
                 This means that the query returned an empty result set.
                 Try again, but don't fail this time.
                 </REATTEMPT>
-               """},
-            {"role": "user", "content": prompt}])
-    print(response.choices[0].message.content)
-    # Pattern to match code blocks that optionally start with ```python or just ```
-    pattern = r'```(?:sql)?\n(.*?)```'
-    matches = re.findall(pattern, response.choices[0].message.content, re.DOTALL)
-
-    # Join all matches into a single string, separated by two newlines
-    sql_code = '\n\n'.join(matches)
-    return sql_code
-
-def getSnowflakeSQL2(prompt, warehouse=warehouse, database=database, schema=schema):
-    data = pd.DataFrame({"promptText": [str(prompt) + "\nSNOWFLAKE ENVIRONMENT:\nwarehouse = " + str(warehouse) + "\ndatabase = " + str(database) + "\nschema = " + str(schema)]})
-    deployment_id = st.secrets.datarobot_deployment_id.sql_code_generator
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
-    # Pattern to match code blocks that optionally start with ```python or just ```
-    pattern = r'```(?:sql)?\n(.*?)```'
-    matches = re.findall(pattern, code, re.DOTALL)
-
-    # Join all matches into a single string, separated by two newlines
-    sql_code = '\n\n'.join(matches)
-    return sql_code
+               """,
+        userPrompt=prompt,
+        deploymentPrompt=str(prompt) + "\nSNOWFLAKE ENVIRONMENT:\nwarehouse = " + str(warehouse) + "\ndatabase = " + str(database) + "\nschema = " + str(schema),
+        cache=True)
 
-def executeSnowflakeQuery(prompt, user, password, account, warehouse, database, schema):
-    # Get the SQL code
-    if openAImode:
-        snowflakeSQL = getSnowflakeSQL(prompt)
+def fetchSnowflakeResults(cur, maxRows=snowflakeMaxResultRows, maxBytes=snowflakeMaxResultBytes):
+    '''
+    Streams a result set in Arrow batches into a DataFrame, stopping early once maxRows or maxBytes is reached.
+    results.attrs["truncated"] is True when rows were left behind.
+    '''
+    batches = []
+    rowCount = 0
+    byteCount = 0
+    truncated = False
+    for batch in cur.fetch_arrow_batches():
+        if batch.num_rows == 0:
+            continue
+        keepRows = min(batch.num_rows, maxRows - rowCount)
+        if byteCount + batch.nbytes > maxBytes:
+            bytesPerRow = batch.nbytes / batch.num_rows
+            keepRows = min(keepRows, int((maxBytes - byteCount) / bytesPerRow))
+        if keepRows < batch.num_rows:
+            batch = batch.slice(0, keepRows)
+            truncated = True
+        batches.append(batch)
+        rowCount += batch.num_rows
+        byteCount += batch.nbytes
+        if truncated:
+            # Stop pulling chunks from Snowflake
+            break
+
+    if batches:
+        table = pa.concat_tables(batches)
+        del batches
+        # split_blocks lets numeric columns without nulls share Arrow's buffers instead of being copied
+        results = table.to_pandas(split_blocks=True, self_destruct=True)
     else:
-        snowflakeSQL = getSnowflakeSQL2(prompt)
+        results = pd.DataFrame(columns=[column[0] for column in cur.description])
+    results.attrs["truncated"] = truncated
+    if truncated:
+        print(f"Query result truncated at {rowCount} rows ({byteCount} bytes)")
+    return results
 
-    # Create a connection using Snowflake Connector
-    conn = snowflake.connector.connect(
-        user=user,
-        password=password,
-        account=account,
-        warehouse=warehouse,
-        database=database,
-        schema=schema,
-        quote_identifiers=(True, '')
-    )
-    results = None
+def cancelSnowflakeQuery(conn, queryId):
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT SYSTEM$CANCEL_QUERY(%s)", (queryId,))
+            print(f"Cancelled query {queryId}: {cur.fetchone()[0]}")
+    except Exception as e:
+        print(f"Error cancelling query {queryId}: {e}")
 
+def getBytesScanned(cur, queryId):
+    try:
+        cur.execute("""
+            SELECT BYTES_SCANNED
+            FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION())
+            WHERE QUERY_ID = %s
+            """, (queryId,))
+        result = cur.fetchone()
+        return result[0] if result else None
+    except Exception as e:
+        print(f"Error fetching bytes scanned for query {queryId}: {e}")
+        return None
+
+def normalizeSQL(sql):
+    '''
+    Strips comments, collapses whitespace and drops trailing semicolons, leaving string literals and quoted identifiers untouched
+    '''
+    def normalize_token(match):
+        if match.group(1):
+            return match.group(1)
+        return " "
+
+    # Comments and the whitespace around them are matched as one run, so each run becomes a single space
+    pattern = r'(\'(?:[^\']|\'\')*\'|"(?:[^"]|"")*")|(?:\s|--[^\n]*|/\*.*?\*/)+'
+    return re.sub(pattern, normalize_token, sql, flags=re.DOTALL).strip().rstrip(";").strip()
+
+def getQueryCachePaths(snowflakeSQL, user, account, database, schema):
+    # The connection runs with the user's default role, so the user decides what the query can see
+    key = hashlib.sha256(f"{account}|{user}|{database}|{schema}|{normalizeSQL(snowflakeSQL)}".encode("utf-8")).hexdigest()
+    folder = os.path.join(cacheDirectory, "query_results")
+    return os.path.join(folder, key + ".parquet"), os.path.join(folder, key + ".json")
+
+# Functions and clauses whose result changes between runs. Keywords that can be used without parentheses match on their own
+nonDeterministicSQLPattern = r'\b(?:CURRENT_DATE|CURRENT_TIME|CURRENT_TIMESTAMP|LOCALTIME|LOCALTIMESTAMP|SYSDATE|SYSTIMESTAMP|SAMPLE|TABLESAMPLE)\b|\b(?:GETDATE|NOW|RANDOM|RANDSTR|UNIFORM|NORMAL|ZIPF|SEQ[1248]|UUID_STRING)\s*\('
+
+def isDeterministicSQL(snowflakeSQL):
+    '''
+    False if the query samples rows or calls a function whose result changes between runs, so its result shouldn't be cached
+    '''
+    # Drop string literals and quoted identifiers so a column named "RANDOM" doesn't count
+    code = re.sub(r'\'(?:[^\']|\'\')*\'|"(?:[^"]|"")*"', " ", normalizeSQL(snowflakeSQL))
+    return re.search(nonDeterministicSQLPattern, code, re.IGNORECASE) is None
+
+def getLastAltered(tables, user, password, account, warehouse, database, schema):
+    if not tables:
+        return {}
+
+    def fetch_last_altered(conn):
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT TABLE_NAME, LAST_ALTERED
+                FROM {database}.INFORMATION_SCHEMA.TABLES
+                WHERE TABLE_SCHEMA = %s
+                AND TABLE_NAME IN ({", ".join(["%s"] * len(tables))})
+                """, [schema] + list(tables))
+            return {row[0]: str(row[1]) for row in cursor.fetchall()}
+
+    return getSnowflakePool(user, password, account, warehouse, database, schema).run(fetch_last_altered)
+
+@st.cache_data(show_spinner=False, ttl=queryCacheLastAlteredSeconds)
+def getRecentLastAltered(tables, user, password, account, warehouse, database, schema):
+    # LAST_ALTERED as of at most queryCacheLastAlteredSeconds ago, so cache hits don't each cost a round trip
+    return getLastAltered(list(tables), user, password, account, warehouse, database, schema)
+
+def getReferencedTables(snowflakeSQL, user, password, account, warehouse, database, schema):
+    # Tables in the schema whose names appear in the query
+    tables = getSnowflakeTables(user, password, account, database, schema, warehouse)
+    return [table for table in tables if re.search(r'(?<![\w$])' + re.escape(table) + r'(?![\w$])', snowflakeSQL, re.IGNORECASE)]
+
+def removeCachedQueryResult(dataPath, metaPath):
+    removeFile(dataPath)
+    removeFile(metaPath)
+
+def getCachedQueryResult(snowflakeSQL, user, password, account, warehouse, database, schema):
+    '''
+    Returns the cached result of a query, or None if there isn't a fresh one
+    '''
+    dataPath, metaPath = getQueryCachePaths(snowflakeSQL, user, account, database, schema)
     try:
-        # Execute the query and fetch the results into a DataFrame
+        with open(metaPath) as f:
+            meta = json.load(f)
+        if time.time() - meta["created"] > queryCacheTTLSeconds:
+            removeCachedQueryResult(dataPath, metaPath)
+            return None
+        if queryCacheCheckLastAltered and meta["lastAltered"]:
+            current = getRecentLastAltered(tuple(sorted(meta["lastAltered"])), user, password, account, warehouse, database, schema)
+            if current != meta["lastAltered"]:
+                print("Cached query result is out of date, a table has changed since it was stored")
+                removeCachedQueryResult(dataPath, metaPath)
+                return None
+        results = pd.read_parquet(dataPath)
+        # Touch the file so eviction treats it as recently used
+        os.utime(dataPath)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading cached query result: {e}")
+        return None
+    results.attrs["truncated"] = meta["truncated"]
+    return results
+
+def storeQueryResult(snowflakeSQL, results, user, password, account, warehouse, database, schema):
+    dataPath, metaPath = getQueryCachePaths(snowflakeSQL, user, account, database, schema)
+    try:
+        os.makedirs(os.path.dirname(dataPath), exist_ok=True)
+        lastAltered = {}
+        if queryCacheCheckLastAltered:
+            tables = getReferencedTables(snowflakeSQL, user, password, account, warehouse, database, schema)
+            lastAltered = getRecentLastAltered(tuple(sorted(tables)), user, password, account, warehouse, database, schema)
+        meta = {"created": time.time(), "sql": snowflakeSQL, "truncated": bool(results.attrs.get("truncated")), "lastAltered": lastAltered}
+
+        def write_meta(path):
+            with open(path, "w") as f:
+                json.dump(meta, f)
+
+        # The result is written first, so a reader that finds the metadata also finds the result
+        writeAtomically(dataPath, lambda path: results.to_parquet(path, index=False))
+        writeAtomically(metaPath, write_meta)
+    except Exception as e:
+        print(f"Error caching query result: {e}")
+        return
+    evictLRU(os.path.dirname(dataPath), ".parquet", queryCacheMaxBytes,
+             remove=lambda path: removeCachedQueryResult(path, path[:-len(".parquet")] + ".json"))
+
+def runSnowflakeSQL(snowflakeSQL, user, password, account, warehouse, database, schema, onPoll=None, validate=False, cache=False):
+    '''
+    Runs SQL asynchronously and polls until it finishes, cancelling it if the deadline passes or the caller is interrupted.
+    Returns the results (None on failure) and a dict with the query ID, elapsed seconds, bytes scanned and error.
+    onPoll(queryId, elapsedSeconds) is called while the query is running.
+    With validate=True, a query that isn't cached goes through validateSnowflakeSQL first and isn't run if that finds a problem.
+    With cache=True, the result is read from and stored in the local query cache, unless the SQL isn't deterministic.
+    '''
+    queryInfo = {"queryId": None, "elapsed": None, "bytesScanned": None, "error": None, "cached": False}
+    start = time.monotonic()
+
+    cache = cache and isDeterministicSQL(snowflakeSQL)
+    results = getCachedQueryResult(snowflakeSQL, user, password, account, warehouse, database, schema) if cache else None
+    if results is not None:
+        queryInfo["cached"] = True
+        queryInfo["elapsed"] = time.monotonic() - start
+        print(f"Query result served from the local cache in {queryInfo['elapsed']:.2f}s")
+        return results, queryInfo
+
+    if validate:
+        queryInfo["error"] = validateSnowflakeSQL(snowflakeSQL, user, password, account, warehouse, database, schema)["error"]
+        if queryInfo["error"]:
+            queryInfo["elapsed"] = time.monotonic() - start
+            return None, queryInfo
+
+    def run_query(conn):
         with conn.cursor() as cur:
-            cur.execute(snowflakeSQL)
-            results = cur.fetch_pandas_all()
+            cur.execute_async(snowflakeSQL)
+            queryId = queryInfo["queryId"] = cur.sfqid
+            try:
+                # Raises if the query failed
+                while conn.is_still_running(conn.get_query_status_throw_if_error(queryId)):
+                    elapsed = time.monotonic() - start
+                    if elapsed > snowflakeQueryTimeoutSeconds:
+                        raise TimeoutError(f"The query did not finish within {snowflakeQueryTimeoutSeconds} seconds and was cancelled")
+                    if onPoll is not None:
+                        onPoll(queryId, elapsed)
+                    time.sleep(snowflakePollSeconds)
+            except snowflake.connector.errors.Error:
+                raise
+            except BaseException:
+                # Timed out, or Streamlit stopped the script because the user re-asked
+                cancelSnowflakeQuery(conn, queryId)
+                raise
+
+            # Fetch the results into a DataFrame
+            cur.get_results_from_sfqid(queryId)
+            results = fetchSnowflakeResults(cur)
             results.columns = results.columns.str.upper()
-    except snowflake.connector.errors.Error as e:
+            queryInfo["bytesScanned"] = getBytesScanned(cur, queryId)
+            return results
+
+    results = None
+    try:
+        results = getSnowflakePool(user, password, account, warehouse, database, schema).run(run_query)
+    except (snowflake.connector.errors.Error, TimeoutError) as e:
         print(f"An error occurred: {e}")
-    finally:
-        conn.close()
+        queryInfo["error"] = str(e)
+    queryInfo["elapsed"] = time.monotonic() - start
+    print(f"Query {queryInfo['queryId']} took {queryInfo['elapsed']:.1f}s and scanned {queryInfo['bytesScanned']} bytes")
+    if cache and results is not None and not results.empty:
+        storeQueryResult(snowflakeSQL, results, user, password, account, warehouse, database, schema)
+
+    return results, queryInfo
+
+def executeSnowflakeQuery(prompt, user, password, account, warehouse, database, schema, onPoll=None, cache=True):
+    # Get the SQL code
+    snowflakeSQL = getSnowflakeSQL(prompt)
+
+    results, queryInfo = runSnowflakeSQL(snowflakeSQL, user, password, account, warehouse, database, schema, onPoll=onPoll, validate=sqlPreflightChecks, cache=cache)
+    return snowflakeSQL, results, queryInfo
+
+def explainSnowflakeSQL(snowflakeSQL, user, password, account, warehouse, database, schema):
+    '''
+    Compiles the query with EXPLAIN, without running it. Returns a dict with the compile error, if any,
+    and the partitions and bytes the plan expects to scan.
+    '''
+    explanation = {"error": None, "partitionsAssigned": None, "bytesAssigned": None}
+
+    def explain(conn):
+        with conn.cursor() as cur:
+            cur.execute("EXPLAIN USING JSON " + normalizeSQL(snowflakeSQL))
+            return cur.fetchone()[0]
 
-    return snowflakeSQL, results
+    try:
+        plan = json.loads(getSnowflakePool(user, password, account, warehouse, database, schema).run(explain))
+        globalStats = plan.get("GlobalStats", {})
+        explanation["partitionsAssigned"] = globalStats.get("partitionsAssigned")
+        explanation["bytesAssigned"] = globalStats.get("bytesAssigned")
+    except snowflake.connector.errors.Error as e:
+        explanation["error"] = str(e)
+    except (TypeError, ValueError) as e:
+        # The query compiled but the plan couldn't be read, so it can still run, just without a cost estimate
+        print(f"Could not read the query plan: {repr(e)}")
+    return explanation
+
+def checkSnowflakeSQL(snowflakeSQL, database, schema, tables, getColumns):
+    '''
+    Parses the query locally and checks the tables and columns it uses. tables lists the tables in the schema and
+    getColumns(tableNames) returns {table: [column names]} for the ones the query uses. Only problems that are certain
+    are reported: columns are checked when they name their table, or when the query reads a single plain table
+    (no joins, table functions, PIVOT or UNPIVOT, which add columns of their own).
+    Returns an error message, or None.
+    '''
+    try:
+        statements = [statement for statement in sqlglot.parse(snowflakeSQL, read="snowflake") if statement is not None]
+    except sqlglot.errors.ParseError as e:
+        return "The query could not be parsed: " + re.sub(r"\x1b\[[0-9;]*m", "", str(e))
+    if len(statements) != 1:
+        return f"The response must be a single query, but it contains {len(statements)} statements"
+    statement = statements[0]
+    if not isinstance(statement, exp.Query):
+        return f"Only SELECT queries are allowed, not {statement.key.upper()}"
+    if not tables:
+        return None
+
+    tableNames = {table.upper(): table for table in tables}
+    derived = {cte.alias_or_name.upper() for cte in statement.find_all(exp.CTE)}
+    derived |= {subquery.alias.upper() for subquery in statement.find_all(exp.Subquery) if subquery.alias}
+    baseTables = {}  # alias or name -> table
+    references = 0
+    for table in statement.find_all(exp.Table):
+        if not isinstance(table.this, exp.Identifier):
+            continue  # Table functions like FLATTEN
+        if table.catalog and table.catalog.upper() != database.upper():
+            continue  # Another database, which isn't described here
+        if table.db and table.db.upper() != schema.upper():
+            continue  # Another schema, which isn't described here
+        name = table.name.upper()
+        if not table.db and name in derived:
+            continue
+        if name not in tableNames:
+            available = ", ".join(sorted(tables)[:50])
+            return f"Table {table.sql(dialect='snowflake')} does not exist in {schema}. Available tables: {available}"
+        baseTables[table.alias_or_name.upper()] = tableNames[name]
+        references += 1
+
+    columns = getColumns(sorted(set(baseTables.values()))) or {}
+    # A table without known columns, because its metadata couldn't be fetched, isn't checked
+    columns = {table: {column.upper() for column in tableColumns} for table, tableColumns in columns.items() if tableColumns}
+    # Older sqlglot versions store the FROM clause under "from"
+    source = statement.args.get("from_") or statement.args.get("from")
+    source = source.this if source is not None else None
+    singleTable = (references == 1 and not derived and isinstance(statement, exp.Select)
+                   and not statement.args.get("joins")
+                   and isinstance(source, exp.Table) and isinstance(source.this, exp.Identifier) and not source.args.get("pivots")
+                   and statement.find(exp.Lateral, exp.Pivot) is None)
+    selectAliases = {alias.alias.upper() for alias in statement.find_all(exp.Alias)}
+    for column in statement.find_all(exp.Column):
+        if isinstance(column.this, exp.Star):
+            continue
+        qualifier = column.table.upper()
+        if qualifier:
+            if qualifier in derived or qualifier not in baseTables:
+                continue
+            table = baseTables[qualifier]
+        elif singleTable and column.name.upper() not in selectAliases:
+            table = next(iter(baseTables.values()))
+        else:
+            continue
+        if table in columns and column.name.upper() not in columns[table]:
+            available = ", ".join(sorted(columns[table])[:100])
+            return f"Column {column.sql(dialect='snowflake')} does not exist in table {table}. Its columns are: {available}"
+    return None
+
+def validateSnowflakeSQL(snowflakeSQL, user, password, account, warehouse, database, schema):
+    '''
+    Pre-flight checks for a generated query: the local parse and metadata check, then EXPLAIN and the scan budget.
+    Returns a dict like explainSnowflakeSQL's, with error set to the first problem found.
+    '''
+    start = time.monotonic()
+    explanation = {"error": None, "partitionsAssigned": None, "bytesAssigned": None}
+    if sqlglot is not None:
+        def getColumns(tables):
+            metadata = getSnowflakeTableMetadata(tables, user, password, account, warehouse, database, schema) or {}
+            return {table: [column[0] for column in details["columns"]] for table, details in metadata.items()}
+
+        try:
+            explanation["error"] = checkSnowflakeSQL(snowflakeSQL, database, schema, getSnowflakeTables(user, password, account, database, schema, warehouse), getColumns)
+        except Exception as e:
+            # A gap in the local checks shouldn't stop the query, EXPLAIN still runs
+            print(f"Local SQL check failed: {repr(e)}")
+        if explanation["error"]:
+            print(f"Pre-flight check rejected the query in {(time.monotonic() - start) * 1000:.0f} ms: {explanation['error']}")
+            return explanation
+
+    if sqlPreflightExplain:
+        explanation = explainSnowflakeSQL(snowflakeSQL, user, password, account, warehouse, database, schema)
+        bytesAssigned = explanation["bytesAssigned"]
+        if not explanation["error"] and snowflakeScanBudgetBytes is not None and bytesAssigned is not None and bytesAssigned > snowflakeScanBudgetBytes:
+            explanation["error"] = (f"The query would scan about {bytesAssigned / 1024 ** 3:.1f} GB, over the budget of "
+                                    f"{snowflakeScanBudgetBytes / 1024 ** 3:.1f} GB. Filter or aggregate so less data is read.")
+        if explanation["error"]:
+            print(f"Pre-flight check rejected the query in {(time.monotonic() - start) * 1000:.0f} ms: {explanation['error']}")
+    return explanation
+
+def executeSpeculativeSnowflakeQuery(prompt, user, password, account, warehouse, database, schema, onPoll=None):
+    '''
+    Writes one SQL candidate per speculativeVariants entry at the same time, then checks them (validateSnowflakeSQL) in parallel.
+    A backend that ignores seed and temperature would return the same candidate for each, so it only writes one.
+    A candidate with a cached result wins straight away. Otherwise the valid candidates run one at a time, cheapest
+    estimated scan first, until one returns rows. Returns the same values as executeSnowflakeQuery; queryInfo also
+    lists every failed candidate under candidateErrors as (sql, error).
+    '''
+    variants = speculativeVariants if getLLMBackend().variesSampling else speculativeVariants[:1]
+    with sessionExecutor(max_workers=len(variants)) as executor:
+        futures = [executor.submit(getSnowflakeSQL, prompt, seed=seed, temperature=temperature) for seed, temperature in variants]
+        candidates = []
+        generationErrors = []
+        for future in futures:
+            try:
+                candidates.append(future.result())
+            except Exception as e:
+                generationErrors.append(e)
+        # Candidates that differ only in comments or whitespace run once
+        distinct = {}
+        for candidate in candidates:
+            distinct.setdefault(normalizeSQL(candidate), candidate)
+        candidates = list(distinct.values())
+        if not candidates:
+            raise generationErrors[0]
+        print(f"Generated {len(candidates)} distinct SQL candidates")
+
+        for candidate in filter(isDeterministicSQL, candidates):
+            results = getCachedQueryResult(candidate, user, password, account, warehouse, database, schema)
+            if results is not None:
+                print("A SQL candidate was served from the local query cache")
+                return candidate, results, {"queryId": None, "elapsed": 0.0, "bytesScanned": None, "error": None, "cached": True, "candidateErrors": []}
+
+        check = validateSnowflakeSQL if sqlPreflightChecks else explainSnowflakeSQL
+        explanations = list(executor.map(lambda candidate: check(candidate, user, password, account, warehouse, database, schema), candidates))
+
+    candidateErrors = [(candidate, explanation["error"]) for candidate, explanation in zip(candidates, explanations) if explanation["error"]]
+    valid = [(candidate, explanation) for candidate, explanation in zip(candidates, explanations) if not explanation["error"]]
+    valid.sort(key=lambda item: item[1]["bytesAssigned"] if item[1]["bytesAssigned"] is not None else float("inf"))
+    print(f"{len(valid)} of {len(candidates)} SQL candidates passed the checks. Estimated bytes: {[explanation['bytesAssigned'] for _, explanation in valid]}")
+
+    snowflakeSQL = candidates[0]
+    results = None
+    queryInfo = {"queryId": None, "elapsed": 0.0, "bytesScanned": None, "error": candidateErrors[0][1] if candidateErrors else None, "cached": False}
+    for snowflakeSQL, explanation in valid:
+        results, queryInfo = runSnowflakeSQL(snowflakeSQL, user, password, account, warehouse, database, schema, onPoll=onPoll, cache=True)
+        if results is not None and not results.empty:
+            break
+        candidateErrors.append((snowflakeSQL, queryInfo["error"] or "The query returned no rows"))
+
+    queryInfo["candidateErrors"] = candidateErrors
+    if results is not None and results.empty and candidateErrors:
+        queryInfo["error"] = candidateErrors[-1][1]
+        results = None
+    return snowflakeSQL, results, queryInfo
 
 @st.cache_data(show_spinner=False)
 def getDataSample(sampleSize):
     sampleSQLprompt = f"""
                       Select a {sampleSize} row random sample using the SAMPLE clause                
                       """
-    if openAImode:
-        sampleSQL = getSnowflakeSQL(sampleSQLprompt)
-    else:
-        sampleSQL = getSnowflakeSQL2(sampleSQLprompt)
+    sampleSQL = getSnowflakeSQL(sampleSQLprompt)
 
-    sql, sample = executeSnowflakeQuery(sampleSQL, user, password, account, warehouse, database, schema)
+    sql, sample, queryInfo = executeSnowflakeQuery(sampleSQL, user, password, account, warehouse, database, schema, cache=False)
     return sample
 
+def chooseSampleSize(sampleSize, columnCount, rowCount, tableBytes):
+    '''
+    Picks how many rows to sample so that the sample fits within tableSampleMaxBytes
+    '''
+    # Snowflake reports compressed bytes, so scale them up to approximate the in-memory width of a row
+    bytesPerRow = max(columnCount, 1) * 16
+    if rowCount and tableBytes:
+        bytesPerRow = max(bytesPerRow, 4 * tableBytes / rowCount)
+    rows = min(sampleSize, int(tableSampleMaxBytes / bytesPerRow))
+    if rowCount is not None:
+        rows = min(rows, rowCount)
+    # The prompt always uses 3 rows per table
+    return max(rows, 3)
+
+def buildSampleSQL(table, rows, rowCount, blockSample=True):
+    name = qualifyTable(table, database, schema)
+    if blockSample and rowCount and rowCount > tableSampleBlockRows:
+        # Oversample the blocks since they vary in size, then keep the rows we need
+        percent = min(100.0, 1000.0 * rows / rowCount)
+        return f"SELECT * FROM {name} SAMPLE SYSTEM ({percent:.6f}) LIMIT {rows}"
+    return f"SELECT * FROM {name} SAMPLE ({rows} ROWS)"
+
 @st.cache_data(show_spinner=False)
-def getTableSample(sampleSize, table):
-    sqlCode, results = executeSnowflakeQuery(f"Retrieve a random sample using SAMPLE({sampleSize} ROWS) from this table: " + str(table), user, password, account, warehouse, database, schema)
+def getTableSample(sampleSize, table, tableMetadata=None):
+    '''
+    Samples a table directly, sized from its column count and bytes in the metadata. Raises if the query fails,
+    so a failure isn't cached.
+    '''
+    tableMetadata = tableMetadata or {}
+    rowCount = tableMetadata.get("rowCount")
+    rows = chooseSampleSize(sampleSize, len(tableMetadata.get("columns", [])), rowCount, tableMetadata.get("bytes"))
+    results, queryInfo = runSnowflakeSQL(buildSampleSQL(table, rows, rowCount), user, password, account, warehouse, database, schema)
+    if results is not None and results.empty and rowCount:
+        # Block sampling can miss every block on a very large table
+        results, queryInfo = runSnowflakeSQL(buildSampleSQL(table, rows, rowCount, blockSample=False), user, password, account, warehouse, database, schema)
+    if results is None:
+        raise ValueError(f"Could not retrieve a sample of {table}: {queryInfo['error']}")
     return results
 
 def getChartCode(prompt):
-    response = client.chat.completions.create(
+    return generateCode(
+        "python",
+        task="plotly_code_generator",
         model="gpt-4o",
         temperature=0.6,
         seed=4242,
-        messages=[
-            {"role": "system",
-             "content": """
+        systemPrompt="""
             <ROLE>
             You are a Plotly chart maker. 
             Your task is to create a function that returns 2 Plotly visualizations of the provided data to help answer a business question.
@@ -748,48 +2498,16 @@ def getChartCode(prompt):
             Try again, but don't fail this time.      
             </REATTEMPT>
             </NECESSARY CONSIDERATIONS>
-            """},
-            {"role": "user", "content": prompt}])
-    # Pattern to match code blocks that optionally start with ```python or just ```
-    pattern = r'```(?:python)?\n(.*?)```'
-    matches = re.findall(pattern, response.choices[0].message.content, re.DOTALL)
-
-    # Join all matches into a single string, separated by two newlines
-    python_code = '\n\n'.join(matches)
-    return python_code
-
-def getChartCode2(prompt):
-    #prompt = "test"
-    data = pd.DataFrame({"promptText": [prompt]})
-    deployment_id = st.secrets.datarobot_deployment_id.plotly_code_generator
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
-    # Pattern to match code blocks that optionally start with ```python or just ```
-    pattern = r'```(?:python)?\n(.*?)```'
-    matches = re.findall(pattern, code, re.DOTALL)
-
-    # Join all matches into a single string, separated by two newlines
-    chart_code = '\n\n'.join(matches)
-    return chart_code
-def createCharts(prompt, results):
+            """,
+        userPrompt=prompt,
+        cache=True)
+
+def createCharts(prompt, results, repairContext=""):
     print("getting chart code...")
-    if openAImode:
-        chartCode = getChartCode(prompt + str(results))
-    else:
-        chartCode = getChartCode2(prompt + str(results))
+    chartCode = getChartCode(buildPrompt("chart code", [
+        ("Business Question", 2, [prompt]),
+        ("Results", 1, renderTableOptions(results)),
+        (None, 3, [repairContext])]))
     print(chartCode.replace("```python", "").replace("```", ""))
     function_dict = {}
     exec(chartCode.replace("```python", "").replace("```", ""), function_dict)  # execute the code created by our LLM
@@ -798,14 +2516,16 @@ def createCharts(prompt, results):
     fig1, fig2 = create_charts(results)
     return fig1, fig2
 
-def getBusinessAnalysis(prompt):
-    response = client.chat.completions.create(
+def getBusinessAnalysis(prompt, stream=False):
+    '''
+    Returns the analysis, or a generator of its pieces as they arrive when stream is True
+    '''
+    request = dict(
+        task="business_analysis",
         model="gpt-4o",
         temperature=0.7,
         seed=42,
-        messages=[
-            {"role": "system",
-             "content": """
+        systemPrompt="""
             ROLE:
             You are a business analyst.
             Your job is to write an answer to the user's question in 3 sections (heading level 3): The Bottom Line, Additional Insights, Follow Up Questions.
@@ -829,30 +2549,129 @@ def getBusinessAnalysis(prompt):
 
             Follow Up Questions
             Offer 2 or 3 follow up questions the user could ask to get deeper insight into the issue in another round of question and answer. When you word these questions, do not use pronouns to refer to the data - always use specific column names. Only refer to data that actually exists in the dataset. For example, don't refer to "sales volume" if there is no "sales volume" column.
-            """},
-            {"role": "user", "content": prompt}])
-    print(response.choices[0].message.content)
-    return response.choices[0].message.content
-
-def getBusinessAnalysis2(prompt):
-    data = pd.DataFrame({"promptText": [prompt]})
-    deployment_id = st.secrets.datarobot_deployment_id.business_analysis
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    business_analysis = predictions_response.json()["data"][0]["prediction"]
-    return business_analysis
+            """,
+        userPrompt=prompt)
+    if stream:
+        return getLLMBackend().stream(**request)
+    response = getLLMBackend().complete(**request)
+    print(response)
+    return response
+
+def compactFrame(table):
+    '''
+    Converts an Arrow table to pandas with compact types: low-cardinality text as categories, integers as int32 and
+    floats as float32 when every value fits exactly. Integers are kept at 32 bits or more so arithmetic in generated code doesn't overflow.
+    '''
+    arrays = []
+    for column in table.columns:
+        if (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)) and len(column) >= csvCategoryMinRows:
+            if pc.count_distinct(column).as_py() <= len(column) * csvCategoryRatio:
+                column = column.dictionary_encode()
+        arrays.append(column)
+    table = pa.Table.from_arrays(arrays, names=table.column_names)
+    # Without split_blocks the columns are copied into pandas' own blocks, which generated code can write to
+    df = table.to_pandas(self_destruct=True)
+    del table, arrays
+
+    if csvDowncastNumbers:
+        for i in range(df.shape[1]):
+            column = df.iloc[:, i]
+            if pd.api.types.is_bool_dtype(column.dtype):
+                continue
+            if pd.api.types.is_integer_dtype(column.dtype) and column.dtype.itemsize > 4:
+                if column.empty or (column.min() >= -2 ** 31 and column.max() < 2 ** 31):
+                    df.isetitem(i, column.astype("int32"))
+            elif pd.api.types.is_float_dtype(column.dtype) and column.dtype.itemsize > 4:
+                smaller = column.astype("float32")
+                if ((smaller.astype("float64") == column) | column.isna()).all():
+                    df.isetitem(i, smaller)
+    return df
+
+def getLoadStats(df, seconds, fileBytes):
+    return {
+        "rows": len(df),
+        "seconds": seconds,
+        "rowsPerSecond": len(df) / seconds if seconds > 0 else float("inf"),
+        "memoryBytes": int(df.memory_usage(deep=True).sum()),
+        "fileBytes": fileBytes}
+
+def readCSV(data):
+    '''
+    Parses CSV bytes into a compact DataFrame with the multithreaded pyarrow reader, falling back to pandas if pyarrow
+    can't parse it. Returns the DataFrame and a dict with the rows, seconds, rows per second and bytes in memory.
+    '''
+    start = time.monotonic()
+    readOptions = pacsv.ReadOptions(use_threads=True, block_size=csvBlockBytes)
+    df = None
+    try:
+        df = compactFrame(pacsv.read_csv(pa.BufferReader(data), read_options=readOptions))
+    except pa.ArrowException as e:
+        print(f"pyarrow could not read the CSV: {repr(e)}")
+    if df is None:
+        df = pd.read_csv(io.BytesIO(data))
+
+    seconds = time.monotonic() - start
+    loadStats = getLoadStats(df, seconds, len(data))
+    print(f"Loaded {loadStats['rows']} rows in {seconds:.2f}s ({loadStats['rowsPerSecond']:.0f} rows/s), "
+          f"{loadStats['memoryBytes'] / 1024 ** 2:.1f} MB in memory from a {len(data) / 1024 ** 2:.1f} MB file")
+    return df, loadStats
+
+def getCSVCachePath(uploadHash):
+    return os.path.join(cacheDirectory, "uploads", uploadHash + ".arrow")
+
+def storeCSV(uploadHash, df):
+    path = getCSVCachePath(uploadHash)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        def write_table(temporaryPath):
+            with pa.OSFile(temporaryPath, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+        writeAtomically(path, write_table)
+    except Exception as e:
+        print(f"Error caching the uploaded file: {e}")
+        return
+    evictLRU(os.path.dirname(path), ".arrow", csvCacheMaxBytes)
+
+def loadCSV(csvFile):
+    '''
+    Returns the upload's hash, its DataFrame and load statistics. A file seen before, by any session, is memory-mapped
+    from the local Arrow cache instead of being parsed. The hash is remembered per upload so reruns don't rehash the bytes.
+    '''
+    hashes = st.session_state.setdefault("uploadHashes", {})
+    fileId = getattr(csvFile, "file_id", None)
+    uploadHash = hashes.get(fileId) if fileId is not None else None
+    if uploadHash is None:
+        uploadHash = hashlib.sha256(csvFile.getvalue()).hexdigest()
+        if fileId is not None:
+            hashes[fileId] = uploadHash
+
+    path = getCSVCachePath(uploadHash)
+    start = time.monotonic()
+    try:
+        with pa.memory_map(path) as source:
+            # Copied out of the map, so the frame is writable and doesn't keep the file open
+            df = pa.ipc.open_file(source).read_all().to_pandas()
+        os.utime(path)  # Mark it as recently used
+        seconds = time.monotonic() - start
+        loadStats = dict(getLoadStats(df, seconds, os.path.getsize(path)), cached=True)
+        print(f"Loaded {loadStats['rows']} rows from the local upload cache in {seconds * 1000:.0f} ms")
+        return uploadHash, df, loadStats
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading the cached upload, parsing it again: {e}")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    df, loadStats = readCSV(csvFile.getvalue())
+    loadStats["cached"] = False
+    storeCSV(uploadHash, df)
+    return uploadHash, df, loadStats
 
 @st.cache_data(show_spinner=False)
 def get_top_frequent_values(df):
@@ -878,103 +2697,233 @@ def get_top_frequent_values(df):
 
     return result_df
 
+@st.cache_data(show_spinner=False, max_entries=8)
+def profileDataset(uploadHash, _df):
+    '''
+    Profiles an uploaded dataset once per upload, keyed by the hash of the file so the DataFrame itself is never hashed.
+    Returns a dict with the row count, per-column type, distinct count and null fraction, the top values of the
+    non-numeric columns (laid out like get_top_frequent_values, plus statistics) and the describe() table.
+    '''
+    df = _df
+    distinctCounts = df.nunique(dropna=True)
+    nullFractions = df.isna().mean() if len(df) else pd.Series(0.0, index=df.columns)
+    columns = pd.DataFrame({
+        "Type": df.dtypes.astype(str),
+        "Distinct Count": distinctCounts,
+        "Null Fraction": nullFractions.round(4)})
+
+    results = []
+    for i, column in enumerate(df.columns):
+        if pd.api.types.is_numeric_dtype(df.dtypes.iloc[i]):
+            continue
+        topValues = df.iloc[:, i].value_counts(sort=True).head(10).index.tolist()
+        results.append({'Non-numeric column name': column,
+                        'Frequent Values': [str(value) for value in topValues],
+                        'Distinct Count': int(distinctCounts.iloc[i]),
+                        'Null Fraction': round(float(nullFractions.iloc[i]), 4)})
+    frequentValues = pd.DataFrame(results, columns=['Non-numeric column name', 'Frequent Values', 'Distinct Count', 'Null Fraction'])
+
+    try:
+        describe = df.describe(include='all')
+    except Exception as e:
+        print(f"Could not describe the dataset: {repr(e)}")
+        describe = pd.DataFrame()
+
+    return {"rowCount": len(df), "columns": columns, "frequentValues": frequentValues, "describe": describe}
+
+@st.cache_data(show_spinner=False)
+def profileSnowflakeTable(table, tableMetadata):
+    '''
+    Profiles the columns of a table in one pushed-down query: approximate distinct counts, null fractions and min/max,
+    plus approximate top values for the non-numeric columns. Returns the same columns as get_top_frequent_values plus
+    the extra statistics, with no frequent values for numeric columns.
+    '''
+    columns = [(col[0], col[1]) for col in tableMetadata["columns"] if col[1] not in profileSkipTypes]
+    if not columns:
+        return pd.DataFrame()
+
+    expressions = ['COUNT(*) AS "ROW_COUNT"']
+    for i, (col_name, col_type) in enumerate(columns):
+        column = quoteIdentifier(col_name)
+        if col_type not in ("NUMBER", "FLOAT"):
+            expressions.append(f'APPROX_TOP_K({column}, {profileTopK}) AS "TOP_{i}"')
+        expressions.append(f'APPROX_COUNT_DISTINCT({column}) AS "DISTINCT_{i}"')
+        expressions.append(f'COUNT_IF({column} IS NULL) AS "NULLS_{i}"')
+        if col_type != "BOOLEAN":
+            expressions.append(f'MIN({column})::VARCHAR AS "MIN_{i}"')
+            expressions.append(f'MAX({column})::VARCHAR AS "MAX_{i}"')
+    profileSQL = f"SELECT {', '.join(expressions)} FROM {qualifyTable(table, database, schema)}"
+
+    profile, queryInfo = runSnowflakeSQL(profileSQL, user, password, account, warehouse, database, schema)
+    if profile is None:
+        raise ValueError(queryInfo["error"])
+    profile = profile.iloc[0]
+    row_count = profile["ROW_COUNT"]
+
+    results = []
+    for i, (col_name, col_type) in enumerate(columns):
+        # APPROX_TOP_K returns a JSON array of [value, count] pairs
+        top_values = [str(value) for value, count in json.loads(profile.get(f"TOP_{i}") or "[]") if value is not None]
+        results.append({
+            'Non-numeric column name': col_name,
+            'Frequent Values': top_values,
+            'Distinct Count': profile[f"DISTINCT_{i}"],
+            'Null Fraction': round(profile[f"NULLS_{i}"] / row_count, 4) if row_count else None,
+            'Min': profile.get(f"MIN_{i}"),
+            'Max': profile.get(f"MAX_{i}"),
+        })
+    return pd.DataFrame(results)
+
 def createChartsAndBusinessAnalysis(businessQuestion, results, prompt):
     attempt_count = 0
     max_attempts = 4
     fig1 = fig2 = None
     analysis = None
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        while attempt_count < max_attempts:
-            chart_future = executor.submit(createCharts, businessQuestion, results)
-            if openAImode:
-                analysis_future = executor.submit(getBusinessAnalysis, prompt + str(results))
-            else:
-                analysis_future = executor.submit(getBusinessAnalysis2, prompt + str(results))
-            try:
-                if fig1 is None or fig2 is None:
-                    fig1, fig2 = chart_future.result(timeout=30)  # Add a timeout for better handling
-                    with st.expander(label="Charts", expanded=True):
-                        st.plotly_chart(fig1, theme="streamlit", use_container_width=True)
-                        st.plotly_chart(fig2, theme="streamlit", use_container_width=True)
-                break  # If operation succeeds, break out of the loop
-            except Exception as e:
-                attempt_count += 1
-                print(f"Chart Attempt {attempt_count} failed with error: {repr(e)}")
-                fig1_str = str(fig1) if fig1 is not None else "None"
-                fig2_str = str(fig2) if fig2 is not None else "None"
-                businessQuestion += f"\nCHART CODE FAILED!  Attempt {attempt_count} failed with error: {repr(e)}\nFig1: {fig1_str}\nFig2: {fig2_str}"
-
-                if attempt_count >= max_attempts:
-                    print("Max charting attempts reached, handling the failure.")
-                    st.write("I was unable to plot the data.")
-                    # Handle the failure after the final attempt
-                else:
-                    print("Retrying the charts...")
+    # The charts go above the analysis, but the analysis is shown first if it's ready first
+    chartContainer = st.container()
+
+    analysisPrompt = buildPrompt("business analysis", [
+        (None, 2, [prompt, "Business Question: " + str(businessQuestion)]),
+        ("Results", 1, renderTableOptions(results))])
+
+    with sessionExecutor(max_workers=2) as executor:
+        chartRepair = RepairContext("CHART CODE")
+        chart_future = executor.submit(createCharts, businessQuestion, results)
 
         try:
             with st.expander(label="Business Analysis", expanded=True):
-                analysis = analysis_future.result(timeout=30)  # Add a timeout for better handling
-                st.markdown(analysis.replace("$", "\$"))
+                if streamingMode:
+                    # Render the analysis as it arrives while the chart code is being written
+                    analysis = st.write_stream(piece.replace("$", "\$") for piece in getBusinessAnalysis(analysisPrompt, stream=True))
+                else:
+                    analysis = getBusinessAnalysis(analysisPrompt)
+                    st.markdown(analysis.replace("$", "\$"))
         except:
             st.write("I am unable to provide the analysis. Please rephrase the question and try again.")
-@st.cache_data(show_spinner=False)
+
+        with chartContainer:
+            while attempt_count < max_attempts:
+                try:
+                    fig1, fig2 = chart_future.result(timeout=30)  # Add a timeout for better handling
+                    with st.expander(label="Charts", expanded=True):
+                        st.plotly_chart(fig1, theme="streamlit", use_container_width=True)
+                        st.plotly_chart(fig2, theme="streamlit", use_container_width=True)
+                    break  # If operation succeeds, break out of the loop
+                except Exception as e:
+                    attempt_count += 1
+                    print(f"Chart Attempt {attempt_count} failed with error: {repr(e)}")
+                    fig1_str = str(fig1) if fig1 is not None else "None"
+                    fig2_str = str(fig2) if fig2 is not None else "None"
+                    chartRepair.add(e, f"Fig1: {fig1_str}\nFig2: {fig2_str}")
+
+                    if attempt_count >= max_attempts:
+                        print("Max charting attempts reached, handling the failure.")
+                        st.write("I was unable to plot the data.")
+                        # Handle the failure after the final attempt
+                    else:
+                        print("Retrying the charts...")
+                        chart_future = executor.submit(createCharts, businessQuestion, results, chartRepair.render())
 def process_tables(dictionary, selectedTables, sampleSize):
+    '''
+    Summarizes and samples every table concurrently. Results are in table order, and a table that fails
+    gets an empty sample plus an entry in tableErrors instead of holding up the others.
+    Only the per-table work is cached, and failures raise there, so a table that failed is tried again on the next run.
+    '''
+    def summarize(table):
+        return summarizeTable(dictionary, table)
+
+    tableMetadata = getSnowflakeTableMetadata(selectedTables, user, password, account, warehouse, database, schema) or {}
+
+    def sample(table):
+        return getTableSample(sampleSize=sampleSize, table=table, tableMetadata=tableMetadata.get(table))
+
+    def profile(table):
+        return profileSnowflakeTable(table, tableMetadata[table])
+
+    with sessionExecutor(max_workers=tableWorkers) as executor:
+        descriptionFutures = [executor.submit(summarize, table) for table in selectedTables]
+        sampleFutures = [executor.submit(sample, table) for table in selectedTables]
+        profileFutures = [executor.submit(profile, table) for table in selectedTables]
+
     tableSamples = []
     tableDescriptions = []
+    tableErrors = {}
     frequentValues = pd.DataFrame()
 
-    for table in selectedTables:
-        if openAImode:
-            tableDescription = summarizeTable(dictionary, table)
-        else:
-            tableDescription = summarizeTable2(dictionary, table)
-
-        results = getTableSample(sampleSize=sampleSize, table=table)
+    for table, descriptionFuture, sampleFuture, profileFuture in zip(selectedTables, descriptionFutures, sampleFutures, profileFutures):
+        try:
+            tableDescription = descriptionFuture.result()
+        except Exception as e:
+            print(f"Error summarizing table {table}: {repr(e)}")
+            tableErrors.setdefault(table, []).append(f"Summary failed: {e}")
+            tableDescription = ""
+        try:
+            results = sampleFuture.result()
+        except Exception as e:
+            print(f"Error sampling table {table}: {repr(e)}")
+            tableErrors.setdefault(table, []).append(f"Sample failed: {e}")
+            results = pd.DataFrame()
         tableSamples.append(results)
         tableDescriptions.append(tableDescription)
-        freqVals = get_top_frequent_values(results)
+        try:
+            freqVals = profileFuture.result()
+        except Exception as e:
+            # Fall back to profiling the sample
+            print(f"Error profiling table {table}: {repr(e)}")
+            freqVals = get_top_frequent_values(results)
         frequentValues = pd.concat([frequentValues, freqVals], axis=0)
 
     smallTableSamples = []
     for table in tableSamples:
-        smallSample = table.sample(n=3)
+        # A fixed seed keeps the prompt, and so the LLM cache key, the same on every rerun
+        smallSample = table.sample(n=min(3, len(table)), random_state=0)
         smallTableSamples.append(smallSample)
 
-    return tableDescriptions, tableSamples, smallTableSamples, frequentValues
-@st.cache_data(show_spinner=False)
-def getSnowflakeTables(user, password, account, database, schema, warehouse):
-    # Establish the connection
-    conn = snowflake.connector.connect(
-        user=user,
-        password=password,
-        account=account,
-        warehouse=warehouse,
-        database=database,
-        schema=schema
-    )
+    return tableDescriptions, tableSamples, smallTableSamples, frequentValues, tableErrors
 
-    try:
-        # Create a cursor object
-        cursor = conn.cursor()
-
-        # Execute a query to fetch the table names
-        cursor.execute(f"""
-                    SELECT table_name
-                    FROM information_schema.tables
-                    WHERE table_schema = '{schema}'
-                """)
+def fetchSnowflakeTables(user, password, account, database, schema, warehouse):
+    def fetch_tables(conn):
+        with conn.cursor() as cursor:
+            # Execute a query to fetch the table names
+            cursor.execute(f"""
+                        SELECT table_name
+                        FROM information_schema.tables
+                        WHERE table_schema = '{schema}'
+                    """)
 
-        # Fetch all table names
-        tables = [row[0] for row in cursor.fetchall()]
-        tables.sort()
+            # Fetch all table names
+            tables = [row[0] for row in cursor.fetchall()]
+            tables.sort()
+            return tables
 
-        return tables
+    tables = getSnowflakePool(user, password, account, warehouse, database, schema).run(fetch_tables)
+    try:
+        with contextlib.closing(openMetadataStore()) as db, db:
+            db.execute("INSERT OR REPLACE INTO schema_tables VALUES (?, ?, ?, ?, ?)", (account, database, schema, json.dumps(tables), time.time()))
+    except Exception as e:
+        print(f"Error storing table list: {e}")
+    return tables
 
-    finally:
-        # Close the cursor and connection
-        cursor.close()
-        conn.close()
+@st.cache_data(show_spinner=False, ttl=metadataRefreshSeconds)
+def getSnowflakeTables(user, password, account, database, schema, warehouse):
+    '''
+    Gets the table list from the local store when there is one, refreshing it in the background once it is stale
+    '''
+    try:
+        with contextlib.closing(openMetadataStore()) as db:
+            stored = db.execute("SELECT tables, fetched_at FROM schema_tables WHERE account = ? AND database = ? AND schema = ?",
+                                (account, database, schema)).fetchone()
+    except Exception as e:
+        print(f"Error reading stored table list: {e}")
+        stored = None
+    if stored is None:
+        return fetchSnowflakeTables(user, password, account, database, schema, warehouse)
+
+    if time.time() - stored[1] > metadataRefreshSeconds:
+        refreshInBackground(("tables", account, database, schema),
+                            lambda: fetchSnowflakeTables(user, password, account, database, schema, warehouse))
+    return json.loads(stored[0])
 
 def mainPage():
     st.image("DataRobot Logo.svg", width=300)
@@ -1007,15 +2956,18 @@ def mainPage():
             with st.spinner("Getting table definitions..."):
                 dictionary = getSnowflakeTableDescriptions(st.session_state['selectedTables'], user, password, account, warehouse, database, schema)
                 print(dictionary)
-                if openAImode:
-                    suggestedQuestions = suggestQuestion(dictionary)
-                else: suggestedQuestions = suggestQuestion2(dictionary)
+                if exactRowCounts:
+                    # Kick off the exact counts now so they are likely finished by the time a question is asked
+                    getExactRowCounts(st.session_state['selectedTables'], user, password, account, warehouse, database, schema)
+                suggestedQuestions = suggestQuestion(dictionary)
 
                 print(suggestedQuestions)
-                tableDescriptions, tableSamples, smallTableSamples, frequentValues = process_tables(dictionary,st.session_state['selectedTables'], sampleSize=1000)
+                tableDescriptions, tableSamples, smallTableSamples, frequentValues, tableErrors = process_tables(dictionary,st.session_state['selectedTables'], sampleSize=1000)
                 with tab2:
                     for i in range(0, len(tableSamples)):
                         st.subheader(st.session_state['selectedTables'][i])
+                        for error in tableErrors.get(st.session_state['selectedTables'][i], []):
+                            st.warning(error)
                         st.caption("Displaying a random sample " + str(len(tableSamples[i])) + " rows")
                         st.write(tableDescriptions[i])
                         st.write(tableSamples[i])
@@ -1042,27 +2994,86 @@ def mainPage():
                     print("------------")
                     print(st.session_state["businessQuestion"])
                     print("------------")
-                    prompt = "Business Question: " + str(st.session_state["businessQuestion"]) + str("\n Data Dictionary: \n") + str(dictionary) + str("\n Data Sample: \n") + str(smallTableSamples) + str("\n Frequent Values: \n") + str(frequentValues)
+                    samples = dict(zip(st.session_state['selectedTables'], smallTableSamples))
+                    sections = [
+                        ("Business Question", 5, [str(st.session_state["businessQuestion"])]),
+                        ("Data Dictionary", 4, [str(dictionary)]),
+                        ("Data Sample", 2, [renderSamples(samples), renderSamples(samples, maxRows=1), ""]),
+                        ("Frequent Values and Column Statistics", 3, [renderFrequentValues(frequentValues), renderFrequentValues(frequentValues, maxValues=3), ""])]
+                    if exactRowCounts:
+                        exactCounts = getExactRowCounts(st.session_state['selectedTables'], user, password, account, warehouse, database, schema)
+                        if exactCounts:
+                            sections.append(("Exact Row Counts", 1, ["\n".join(f"{table}: {count}" for table, count in exactCounts.items()), ""]))
+                    prompt = buildPrompt("SQL", sections)
                     print(prompt)
                     print("------------")
 
+                    # Cancel a query still running from a previous question
+                    if st.session_state.get("snowflakeQueryId"):
+                        getSnowflakePool(user, password, account, warehouse, database, schema).run(
+                            lambda conn: cancelSnowflakeQuery(conn, st.session_state["snowflakeQueryId"]))
+                        st.session_state["snowflakeQueryId"] = None
+
+                    queryStatus = st.empty()
+
+                    # Show progress while a query runs. Streamlit stops the script here if the user re-asks, which cancels the query.
+                    def showQueryProgress(queryId, elapsed):
+                        st.session_state["snowflakeQueryId"] = queryId
+                        queryStatus.caption(f"Running query {queryId} ({elapsed:.0f}s)")
+
+                    # Reuse the SQL of the same question on these tables, or show the model a similar one as an example
+                    sqlCode = None
+                    results = None
+                    answered = False
+                    answerScope = hashlib.sha256(json.dumps(["snowflake", account, database, schema, sorted(st.session_state['selectedTables'])]).encode("utf-8")).hexdigest()
+                    similar = findAnsweredQuestion(answerScope, st.session_state["businessQuestion"])
+                    if similar is not None and similar["exact"]:
+                        results, queryInfo = runSnowflakeSQL(similar["code"], user, password, account, warehouse, database, schema, onPoll=showQueryProgress, validate=sqlPreflightChecks, cache=True)
+                        st.session_state["snowflakeQueryId"] = None
+                        queryStatus.empty()
+                        if results is not None and not results.empty:
+                            sqlCode = similar["code"]
+                            answered = True
+                            rememberAnswer(answerScope, st.session_state["businessQuestion"], sqlCode)
+                        else:
+                            print(f"The reused SQL failed, generating new SQL: {queryInfo['error']}")
+                            results = None
+                    if similar is not None and not answered:
+                        prompt = addAnswerExample(prompt, similar, "sql")
+
                     attempts = 0
                     max_retries = 5
-                    while attempts < max_retries:
+                    repair = RepairContext("QUERY")
+                    while not answered and attempts < max_retries:
                         print("Generating code to get the answer. Attempt: " + str(attempts))
                         sqlCode = None
+                        queryInfo = None
                         try:
-                            sqlCode, results = executeSnowflakeQuery(prompt, user, password, account, warehouse,database, schema)
+                            execute = executeSpeculativeSnowflakeQuery if speculativeSQL else executeSnowflakeQuery
+                            sqlCode, results, queryInfo = execute(prompt + repair.render(), user, password, account, warehouse,database, schema, onPoll=showQueryProgress)
+                            st.session_state["snowflakeQueryId"] = None
+                            queryStatus.empty()
+                            print(f"Snowflake pool: {getSnowflakePoolStats()}")
+                            print(f"LLM cache: {getLLMCacheStats()}")
+                            print(f"LLM limits: {getLLMLimiterStats()}")
+                            print(f"Query {queryInfo['queryId']}: {queryInfo['elapsed']:.1f}s, {queryInfo['bytesScanned']} bytes scanned")
+                            if results is None: raise ValueError(queryInfo["error"])
                             print("Query Result:")
                             print(sqlCode)
                             print(results.head(3))
                             if results.empty: raise ValueError("The DataFrame is empty, retrying...")
+                            rememberAnswer(answerScope, st.session_state["businessQuestion"], sqlCode)
                             break  # If the function succeeds, exit the loop
                         except Exception as e:
                             attempts += 1
                             print(f"Query attempt {attempts} failed with error: {repr(e)}")
                             sqlCode_str = str(sqlCode) if sqlCode is not None else "None"
-                            prompt += f"\nQUERY FAILED! Attempt {attempts} failed with error: {repr(e)}\nSQL Code: {sqlCode_str}"
+                            candidateErrors = queryInfo.get("candidateErrors") if queryInfo else None
+                            if candidateErrors:
+                                for candidateSQL, candidateError in candidateErrors:
+                                    repair.add(candidateError, f"SQL Code: {candidateSQL}")
+                            else:
+                                repair.add(e, f"SQL Code: {sqlCode_str}")
                             if attempts == max_retries:
                                 print("Max retries reached.")
                                 break
@@ -1072,6 +3083,8 @@ def mainPage():
                         with st.expander(label="Code", expanded=False):
                             st.code(sqlCode, language="sql")
                         with st.expander(label="Result", expanded=True):
+                            if results.attrs.get("truncated"):
+                                st.caption(f"The result was too large to retrieve in full. Showing the first {len(results)} rows.")
                             st.table(results)
                     except:
                         st.write(
@@ -1084,76 +3097,57 @@ def mainPage():
                 with st.spinner("Processing data, see Explore tab for details..."):
                     with tab2:
                         # df = pd.read_csv(r"C:\Users\BrettOlmstead\PycharmProjects\DataAnalyst - Snowflake\DataAnalystGPT4oCustomAppSnowflakeDemo\DR_Demo_Employee_Attrition.csv")
-                        df = pd.read_csv(csvFile)
+                        uploadHash, df, loadStats = loadCSV(csvFile)
+                        st.caption(f"Loaded {loadStats['rows']:,} rows{' from the local cache' if loadStats['cached'] else ''} in {loadStats['seconds']:.2f}s "
+                                   f"({loadStats['rowsPerSecond']:,.0f} rows/s). {loadStats['memoryBytes'] / 1024 ** 2:,.1f} MB in memory.")
+                        # Profile the upload once. Everything below reads the profile instead of rescanning df.
+                        datasetProfile = profileDataset(uploadHash, df)
                         # Display the dataframe
                         with st.expander(label="First 10 Rows", expanded=False):
                             st.dataframe(df.head(10))
 
                         try:
                             with st.expander(label="Column Descriptions", expanded=False):
-                                st.dataframe(df.describe(include='all'))
+                                st.dataframe(datasetProfile["describe"])
                         except:
                             pass
 
                         try:
                             with st.expander(label="Unique and Frequent Values", expanded=False):
-                                st.dataframe(get_top_frequent_values(df))
+                                st.dataframe(datasetProfile["frequentValues"])
                         except Exception as e:
                             print(e)
 
                         try:
                             with st.expander(label="Data Dictionary", expanded=True):
                                 with st.spinner("Making dictionary..."):
-                                    # Initialize an empty list to hold the markdown strings
-                                    dictionary_chunks = []
-                                    # Define the chunk size
-                                    chunk_size = 10
-                                    total_columns = len(df.columns)
+                                    frequentValues = datasetProfile["frequentValues"]
+
+                                    # Chunks of columns sized to the token budget, in column order
+                                    chunk_prompts = buildDictionaryChunkPrompts(df, frequentValues)
+                                    total_chunks = len(chunk_prompts)
 
                                     # Initialize the progress bar
                                     progress_placeholder = st.empty()  # Placeholder for the progress bar
+                                    progress_placeholder.progress(0.0, text=f'Describing {len(df.columns)} columns in {total_chunks} chunks. Finished 0 of {total_chunks} chunks')
 
-                                    for start in range(0, total_columns, chunk_size):
-                                        # Update the progress bar and text
-                                        current_chunk = start // chunk_size + 1
-                                        total_chunks = (total_columns + chunk_size - 1) // chunk_size
-                                        progress = current_chunk / total_chunks
-
-                                        with progress_placeholder.container():
-                                            st.progress(progress,
-                                                        text=f'Processing {chunk_size} columns at a time in chunks. Currently working on chunk {current_chunk} of {total_chunks}')
-
-                                        # Select the subset of columns
-                                        end = min(start + chunk_size, total_columns)
-                                        subset = df.iloc[:10, start:end]
-                                        data = "First 10 Rows: \n" + str(
-                                            subset) + "\n Unique and Frequent Values of Categorical Data: \n" + str(
-                                            get_top_frequent_values(df))
-
-                                        # Call the function and collect the result
-                                        if openAImode:
-                                            dictionary_chunk = getDataDictionary(data)
-                                        else:
-                                            dictionary_chunk = getDataDictionary2(data)
-
-
-                                        dictionary_chunks.append(dictionary_chunk)
+                                    # The chunks are described concurrently. The progress bar counts finished chunks and the parts are kept in column order.
+                                    with sessionExecutor(max_workers=dictionaryWorkers) as executor:
+                                        chunk_futures = [executor.submit(getDataDictionary, data) for data in chunk_prompts]
+                                        for finished, future in enumerate(concurrent.futures.as_completed(chunk_futures), start=1):
+                                            progress_placeholder.progress(finished / total_chunks,
+                                                                          text=f'Describing {len(df.columns)} columns in {total_chunks} chunks. Finished {finished} of {total_chunks} chunks')
+                                    dictionary_chunks = [future.result() for future in chunk_futures]
 
                                     # Remove the progress bar when complete
                                     progress_placeholder.empty()
                                 with st.spinner("Putting it all together..."):
-                                    if openAImode:
-                                        dictionary = assembleDictionaryParts(dictionary_chunks)
-                                    else:
-                                        dictionary = assembleDictionaryParts2(dictionary_chunks)
+                                    dictionary = assembleDictionary(dictionary_chunks)
                                     st.markdown(dictionary)
                         except:
                             pass
             with tab1:
-                if openAImode:
-                    suggestedQuestions = suggestQuestion(dictionary)
-                else:
-                    suggestedQuestions = suggestQuestion2(dictionary)
+                suggestedQuestions = suggestQuestion(dictionary)
                 print(suggestedQuestions)
                 st.write(suggestedQuestions)
                 # Initialize businessQuestion session state variable
@@ -1177,27 +3171,54 @@ def mainPage():
                         print("------------")
                         print(st.session_state["businessQuestion"])
                         print("------------")
-                        prompt = "Business Question: " + str(st.session_state["businessQuestion"]) +"\n Data Sample: \n" + str(df.head(3)) + "\n Unique and Frequent Values of Categorical Data: \n" + str(get_top_frequent_values(df)) + str("\n Data Dictionary: \n") + str(dictionary)
+                        frequentValues = datasetProfile["frequentValues"]
+                        prompt = buildPrompt("Python", [
+                            ("Business Question", 5, [str(st.session_state["businessQuestion"])]),
+                            ("Data Sample", 2, [renderSamples(df.head(3)), renderSamples(df.head(1)), ""]),
+                            ("Unique and Frequent Values of Categorical Data", 3, [renderFrequentValues(frequentValues), renderFrequentValues(frequentValues, maxValues=3), ""]),
+                            ("Data Dictionary", 4, [str(dictionary)]),
+                            ("Categorical Columns", 4, [renderCategoricalColumns(df), ""]),
+                            ("Column Profile", 1, [renderTable(datasetProfile["columns"], maxRows=len(datasetProfile["columns"])), ""])])
                         print(prompt)
                         print("------------")
 
+                        # Reuse the code of the same question about this file, or show the model a similar one as an example
+                        pythonCode = None
+                        results = None
+                        answered = False
+                        similar = findAnsweredQuestion(uploadHash, st.session_state["businessQuestion"])
+                        if similar is not None and similar["exact"]:
+                            try:
+                                results = runPythonCode(similar["code"], df)
+                                if results.empty: raise ValueError("The DataFrame is empty")
+                                pythonCode = similar["code"]
+                                answered = True
+                                rememberAnswer(uploadHash, st.session_state["businessQuestion"], pythonCode)
+                            except Exception as e:
+                                print(f"The reused code failed, generating new code: {repr(e)}")
+                                results = None
+                        if similar is not None and not answered:
+                            prompt = addAnswerExample(prompt, similar, "python")
+
                         attempts = 0
                         max_retries = 10
-                        while attempts < max_retries:
+                        repair = RepairContext("QUERY")
+                        while not answered and attempts < max_retries:
                             print("Generating code to get the answer. Attempt: " + str(attempts))
                             pythonCode = None
                             try:
-                                pythonCode, results = executePythonCode(prompt, df)
+                                pythonCode, results = executePythonCode(prompt + repair.render(), df)
                                 print("Query Result:")
                                 print(pythonCode)
                                 print(results.head(3))
                                 if results.empty: raise ValueError("The DataFrame is empty, retrying...")
+                                rememberAnswer(uploadHash, st.session_state["businessQuestion"], pythonCode)
                                 break  # If the function succeeds, exit the loop
                             except Exception as e:
                                 attempts += 1
                                 print(f"Query attempt {attempts} failed with error: {repr(e)}")
                                 pythonCode_str = str(pythonCode) if pythonCode is not None else "None"
-                                prompt += f"\nQUERY FAILED! Attempt {attempts} failed with error: {repr(e)}\nSQL Code: {pythonCode_str}"
+                                repair.add(e, f"Python Code: {pythonCode_str}")
                                 if attempts == max_retries:
                                     print("Max retries reached.")
                                     break